@@ -1,26 +1,76 @@
+import io
 import contextlib
 import datetime
+import hashlib
 import time
 import os
-from typing import Callable, Optional
+import threading
+from typing import Callable, Optional, Union
 from abc import ABC, abstractmethod
 
 import requests
 import msgspec
 
 from selenium.webdriver.common.by import By
+from selenium.webdriver.common.keys import Keys
+from selenium.webdriver.common.action_chains import ActionChains
 from selenium.webdriver.support.wait import WebDriverWait
 from selenium.webdriver.remote.webelement import WebElement
 from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import NoSuchElementException, TimeoutException
+from selenium.common.exceptions import (
+    InvalidSessionIdException,
+    NoSuchElementException,
+    TimeoutException,
+    WebDriverException,
+)
 from PIL import Image
 
-from deipnon.config import BotConfig
+from deipnon.config import (
+    BROWSER_FIELDS,
+    MODEL_FIELDS,
+    BotConfig,
+    diff_config,
+    get_targets,
+)
 from deipnon.utils import get_logger
+from deipnon.metrics import (
+    BOOK_SECONDS,
+    BROWSER_RESTARTS,
+    CAPTCHA_ATTEMPTS,
+    CAPTCHA_FAILURES,
+    CAPTCHA_INFERENCE_SECONDS,
+    LOGIN_SECONDS,
+    RETRY_ATTEMPTS,
+)
+from deipnon.profiler import get_profile_dir, get_profile_mode, profile_phase
+from deipnon.recorder import SessionRecorder
 from deipnon.predict import Captcha
+from deipnon.captchaService import CaptchaClient, CaptchaServiceError
 
 logger = get_logger(__name__)
 
+# watch mode never refreshes the page faster than this
+MIN_WATCH_INTERVAL_SEC = 1.0
+WATCH_REPORT_POLLS = 30
+
+
+def load_captcha_model(
+    bot_config: BotConfig,
+) -> Union[Captcha, CaptchaClient]:
+    """Connect to the shared captcha service if given, or load the model"""
+    captcha_service = bot_config.captcha_service
+    if captcha_service:
+        return CaptchaClient(captcha_service)
+
+    model_path = bot_config.model_path
+
+    assert model_path is not None and os.path.exists(
+        model_path
+    ), f"model_path ({model_path}) is invalid"
+
+    logger.info("Initial yolo model %s", model_path)
+    return Captcha(model_path, bot_config.inference_threads)
+
 
 class BotBase(ABC):
 
@@ -32,29 +82,69 @@ class BotBase(ABC):
         end_time: datetime.datetime
         button: WebElement
 
-    def __init__(self, bot_config: BotConfig):
+    def __init__(self, bot_config: BotConfig, model=None):
         self.driver = None
-        self.model = None
+        self.model = model
+        self.own_model = model is None
+        self.logged_in = False
+        self.recorder = None
         self.bot_config = bot_config
-        self.initial_model()
+        # config updates must not interleave with login or book
+        self.session_lock = threading.RLock()
+        if self.model is None:
+            self.initial_model()
 
     def __del__(self):
         if self.driver:
             self.driver.quit()
 
     def close(self):
+        if self.recorder:
+            self.__record("close")
+            self.recorder.save()
+            self.recorder = None
         if self.driver:
             self.driver.quit()
-
-    def initial_model(self):
-        model_path = self.bot_config.model_path
-
-        assert model_path is not None and os.path.exists(
-            model_path
-        ), f"model_path ({model_path}) is invalid"
-
-        logger.info("Initial yolo model %s", model_path)
-        self.model = Captcha(model_path)
+            self.driver = None
+        self.logged_in = False
+
+    def initial_model(self, model=None):
+        """Use the given shared model, or load an own one from the config"""
+        with self.session_lock:
+            old_model = self.model if self.own_model else None
+            own_model = model is None
+            if own_model:
+                model = load_captcha_model(self.bot_config)
+            self.model = model
+            self.own_model = own_model
+            # a replaced client would keep its connection open
+            if isinstance(old_model, CaptchaClient):
+                old_model.close()
+
+    def update_config(self, bot_config: BotConfig):
+        """Apply a new config, only reload what the changed fields need"""
+        with self.session_lock:
+            changed = diff_config(self.bot_config, bot_config)
+            self.bot_config = bot_config
+            if len(changed) > 0:
+                logger.info("Config changed: %s", ", ".join(sorted(changed)))
+
+            if changed & MODEL_FIELDS and self.own_model:
+                self.initial_model()
+            elif "inference_threads" in changed and isinstance(
+                self.model, Captcha
+            ):
+                # torch applies it to the loaded model
+                self.model.set_num_threads(bot_config.inference_threads)
+
+            if changed & BROWSER_FIELDS and self.driver is not None:
+                logger.info("Restart browser")
+                BROWSER_RESTARTS.inc()
+                logged_in = self.logged_in
+                self.close()
+                self.initial_browser()
+                if logged_in:
+                    self.login()
 
     @abstractmethod
     def initial_browser(self):
@@ -66,10 +156,55 @@ class BotBase(ABC):
         cookies = {auth_key: auth_token}
 
         with requests.get(
-            image_url, cookies=cookies, stream=True, timeout=timeout_sec
+            image_url, cookies=cookies, timeout=timeout_sec
         ) as r:
-            img = Image.open(r.raw)
-        return img
+            image_bytes = r.content
+        if self.recorder:
+            self.recorder.captcha(
+                image_url,
+                image_bytes,
+                r.status_code,
+                dict(r.headers),
+                r.elapsed.total_seconds(),
+            )
+        return Image.open(io.BytesIO(image_bytes))
+
+    def __profile(self, phase: str):
+        return profile_phase(
+            get_profile_dir(self.bot_config.profile_dir),
+            phase,
+            self.driver,
+            get_profile_mode(self.bot_config.profile_mode),
+        )
+
+    def __start_recording(self):
+        record_dir = self.bot_config.record_dir
+        if not record_dir or self.recorder is not None:
+            return
+        os.makedirs(record_dir, exist_ok=True)
+        timestamp = datetime.datetime.now().strftime(r"%Y%m%d-%H%M%S")
+        archive_path = os.path.join(
+            record_dir, f"session-{timestamp}-{id(self):x}.zip"
+        )
+        logger.info("Record the session to %s", archive_path)
+        self.recorder = SessionRecorder(archive_path)
+
+    def __record(self, label: str, collect_network: bool = True):
+        """Snapshot the page and drain the network log into the recording.
+
+        Draining costs one webdriver call per response, so it is only done
+        after a submit and never between opening a ticket and submitting.
+        """
+        if self.recorder is None or self.driver is None:
+            return
+        try:
+            if collect_network:
+                self.recorder.collect_network(self.driver)
+            self.recorder.snapshot(
+                label, self.driver.current_url, self.driver.page_source
+            )
+        except WebDriverException as e:
+            logger.warning("Record %s failed: %s", label, e)
 
     @contextlib.contextmanager
     def __wait_until_finish_loading(
@@ -138,15 +273,28 @@ class BotBase(ABC):
                 time.sleep(delay_sec)
             logger.info("%d try", i)
 
+            task = func.__name__.strip("_")
             try:
                 if func():
+                    RETRY_ATTEMPTS.inc(task=task, outcome="success")
                     return True
+                RETRY_ATTEMPTS.inc(task=task, outcome="failed")
             except NoSuchElementException as e:
+                RETRY_ATTEMPTS.inc(task=task, outcome=type(e).__name__)
                 logger.error("Cannot find the element! %s", e)
             except TimeoutException as e:
+                RETRY_ATTEMPTS.inc(task=task, outcome=type(e).__name__)
                 logger.error("Time ran out! %s", e)
             except AssertionError as e:
+                RETRY_ATTEMPTS.inc(task=task, outcome=type(e).__name__)
                 logger.error("Assertion: %s", e)
+            except CaptchaServiceError as e:
+                RETRY_ATTEMPTS.inc(task=task, outcome=type(e).__name__)
+                logger.error("Captcha service: %s", e)
+            except Exception as e:
+                # not retried, but still an attempt
+                RETRY_ATTEMPTS.inc(task=task, outcome=type(e).__name__)
+                raise
 
         return False
 
@@ -162,6 +310,7 @@ class BotBase(ABC):
         # open target web page
         with self.__wait_until_finish_loading(10):
             self.driver.get(web_url)
+        self.__record("login-page", collect_network=False)
 
         # fetch captcha
         image_element = self.driver.find_element(By.CLASS_NAME, "z-bwcaptcha")
@@ -178,7 +327,9 @@ class BotBase(ABC):
         )
 
         # decode
-        decode_str = self.model.predict(image)
+        with self.__profile("captcha"), CAPTCHA_INFERENCE_SECONDS.time():
+            decode_str = self.model.predict(image)
+        CAPTCHA_ATTEMPTS.inc()
 
         # enter the string
         input_fields = self.driver.find_elements(
@@ -192,6 +343,7 @@ class BotBase(ABC):
         # press login
         with self.__wait_until_finish_loading(10, ignore_timeout=True):
             self.driver.find_element(By.CLASS_NAME, "z-button-os").click()
+        self.__record("login-result")
 
         # check whether login succeed
         info_data = self.__try_find_info_msg(timeout_sec=0)
@@ -200,28 +352,53 @@ class BotBase(ABC):
 
         info_msg, info_confirm_btn = info_data
         info_confirm_btn.click()
+        CAPTCHA_FAILURES.inc()
         logger.error("Login failed, reason: %s", info_msg)
         return False
 
     def login(self) -> bool:
-        return self.__retry_task(self.__login)
+        with self.session_lock:
+            self.__start_recording()
+            with self.__profile("login"), LOGIN_SECONDS.time():
+                self.logged_in = self.__retry_task(self.__login)
+            if self.recorder:
+                self.recorder.save()
+            # the model is not needed until the next login
+            if self.logged_in and self.bot_config.lean_mode:
+                self.model.release()
+            return self.logged_in
 
     def refresh(self, timeout_sec: int):
         with self.__wait_until_finish_loading(timeout_sec):
             self.driver.refresh()
 
-    def __book(self):
-        ticket_name = self.bot_config.ticket_name
-        ticket_item_name = self.bot_config.ticket_item_name
-
-        self.refresh(20)
-        table = self.__wait_and_find_element(
+    def __find_ticket_table(self) -> WebElement:
+        return self.__wait_and_find_element(
             (
                 By.XPATH,
                 "//div[@class='z-tabpanel' and not(contains(@style,'display:none'))]//div[@class='z-grid-body']//tbody[contains(@class, 'z-rows')]",
             ),
             timeout_sec=5,
         )
+
+    def __fingerprint_tickets(self, table: WebElement) -> str:
+        """Hash the row data of the ticket table in one webdriver call"""
+        rows_data = self.driver.execute_script(
+            """
+            return Array.from(
+                arguments[0].querySelectorAll(':scope > tr.z-row')
+            ).map((row) => {
+                const button = row.querySelector('button');
+                return row.innerText + (button && button.disabled ? '|x' : '');
+            }).join('\\n');
+            """,
+            table,
+        )
+        return hashlib.blake2b(
+            str(rows_data).encode(), digest_size=16
+        ).hexdigest()
+
+    def __scrape_tickets(self, table: WebElement) -> list[Ticket]:
         rows = table.find_elements(
             By.XPATH, "./tr[contains(@class, 'gridcss z-row')]"
         )
@@ -256,13 +433,22 @@ class BotBase(ABC):
             )
         )
         logger.info("Ticket:\n%s", "\n".join(map(str, tickets)))
+        return tickets
 
-        # find the target ticket
-        for ticket in tickets:
-            if ticket_name in ticket.name:
-                ticket.button.click()
-                logger.info("Plan to sign up %s", ticket)
-                break
+    def __close_popup(self, pop_window: WebElement):
+        try:
+            pop_window.find_element(
+                By.XPATH, ".//div[contains(@class, 'z-window-close')]"
+            ).click()
+        except NoSuchElementException:
+            ActionChains(self.driver).send_keys(Keys.ESCAPE).perform()
+
+    def __open_ticket(
+        self, ticket: Ticket
+    ) -> tuple[Optional[WebElement], Optional[str]]:
+        """Open the popup of the ticket, return it or the error message"""
+        ticket.button.click()
+        logger.info("Plan to sign up %s", ticket)
 
         # get pop window
         pop_window = self.__wait_and_find_element(
@@ -275,49 +461,220 @@ class BotBase(ABC):
         if info_data is not None:
             info_msg, info_confirm_btn = info_data
             info_confirm_btn.click()
-            logger.error("Book failed, reason: %s", info_msg)
-            return False
+            return None, info_msg
+        return pop_window, None
 
-        # click list
+    def __index_items(self, pop_window: WebElement) -> list[WebElement]:
+        """Open the combobox once and list its selectable items"""
         select_bar = pop_window.find_element(
             By.XPATH, "//input[contains(@class, 'z-combobox-inp')]"
         )
         select_bar.click()
 
-        # get list
         select_list = self.__wait_and_find_element(
             (By.XPATH, "//div[contains(@class, 'z-combobox-pp')]"),
             timeout_sec=5,
         )
-        select_items = select_list.find_elements(
+        return select_list.find_elements(
             By.XPATH, "//tr[@class='z-comboitem']"
         )
 
-        # find the target item
-        found = False
-        for item in select_items:
-            if ticket_item_name in item.text:
-                item.click()
-                found = True
-        assert found, f"Cannot find the target item ({ticket_item_name})"
+    def __book_ticket(
+        self, tickets: list[Ticket], detected_at: Optional[float] = None
+    ) -> bool:
+        """Try the targets in order on the scraped tickets, no refresh"""
+        targets = get_targets(self.bot_config)
+
+        # the first ticket row matching each target, looked up once
+        ticket_index: dict[str, Optional[BotBase.Ticket]] = {}
+        for target in targets:
+            if target.ticket_name not in ticket_index:
+                ticket_index[target.ticket_name] = next(
+                    (
+                        ticket
+                        for ticket in tickets
+                        if target.ticket_name in ticket.name
+                    ),
+                    None,
+                )
+
+        opened_ticket = None
+        pop_window = None
+        items: list[tuple[str, WebElement]] = []
+        for rank, target in enumerate(targets, start=1):
+            target_str = (
+                f"{rank}/{len(targets)} "
+                f"({target.ticket_name} / {target.ticket_item_name})"
+            )
+            ticket = ticket_index[target.ticket_name]
+            if ticket is None:
+                logger.info("Target %s: ticket not found", target_str)
+                continue
+
+            if ticket is not opened_ticket:
+                if pop_window is not None:
+                    self.__close_popup(pop_window)
+                    pop_window = None
+                opened_ticket = ticket
+                pop_window, error_msg = self.__open_ticket(ticket)
+                if pop_window is None:
+                    logger.error(
+                        "Target %s: book failed, reason: %s",
+                        target_str,
+                        error_msg,
+                    )
+                    continue
+                # read the item texts once, later targets reuse them
+                items = [
+                    (item.text, item)
+                    for item in self.__index_items(pop_window)
+                ]
+            elif pop_window is None:
+                # the popup of this ticket already failed
+                logger.info("Target %s: ticket unavailable", target_str)
+                continue
+            # otherwise the previous target found no item on this ticket,
+            # nothing was selected and the combobox is still open
+
+            # find the target item
+            target_item = next(
+                (
+                    item
+                    for text, item in items
+                    if target.ticket_item_name in text
+                ),
+                None,
+            )
+            if target_item is None:
+                logger.info("Target %s: item not found", target_str)
+                continue
+            target_item.click()
 
-        # send submit
-        submit_btn = pop_window.find_element(
-            By.XPATH,
-            "//button[contains(@class, 'cssbtn1') and contains(@class, 'z-button-os')]",
-        )
-        submit_btn.click()
+            # send submit
+            submit_btn = pop_window.find_element(
+                By.XPATH,
+                "//button[contains(@class, 'cssbtn1') and contains(@class, 'z-button-os')]",
+            )
+            submit_btn.click()
+            if detected_at is not None:
+                logger.info(
+                    "Detection to submit: %.1f ms",
+                    (time.perf_counter() - detected_at) * 1000,
+                )
+
+            # get the result
+            info_data = self.__try_find_info_msg(timeout_sec=0)
+            self.__record("book-result")
+            if info_data is not None:
+                info_msg, info_confirm_btn = info_data
+                info_confirm_btn.click()
+                logger.error(
+                    "Target %s: book result: %s", target_str, info_msg
+                )
+                return True
+
+            logger.error("Target %s: book failed", target_str)
+            return False
 
-        # get the result
-        info_data = self.__try_find_info_msg(timeout_sec=0)
-        if info_data is not None:
-            info_msg, info_confirm_btn = info_data
-            info_confirm_btn.click()
-            logger.error("Book result: %s", info_msg)
-            return True
+        self.__record("tickets")
+        # let the retry refresh the page, a ticket may be released meanwhile
+        raise AssertionError("No acceptable target is available")
 
-        logger.error("Book failed")
-        return False
+    def __book(self):
+        self.refresh(20)
+        table = self.__find_ticket_table()
+        tickets = self.__scrape_tickets(table)
+        return self.__book_ticket(tickets)
 
     def book(self) -> bool:
-        return self.__retry_task(self.__book)
+        with self.session_lock:
+            with self.__profile("book"), BOOK_SECONDS.time():
+                booked = self.__retry_task(self.__book)
+            if self.recorder:
+                self.recorder.save()
+            return booked
+
+    def __is_target_bookable(self, tickets: list[Ticket]) -> bool:
+        for target in get_targets(self.bot_config):
+            for ticket in tickets:
+                if target.ticket_name in ticket.name:
+                    if ticket.button.is_enabled():
+                        return True
+                    break
+        return False
+
+    def watch(self, stop_event: Optional[threading.Event] = None) -> bool:
+        """Poll the ticket table and book as soon as the target is bookable.
+
+        Rows are only parsed when the fingerprint of the table changes.
+        Return True once booked, False if stopped or after watch_max_sec.
+        """
+        fingerprint = None
+        poll_count = 0
+        poll_sec = 0.0
+        watch_start = time.monotonic()
+        while stop_event is None or not stop_event.is_set():
+            interval_sec = max(
+                self.bot_config.watch_interval_sec, MIN_WATCH_INTERVAL_SEC
+            )
+            # read at each poll, the limit may be edited while watching
+            max_sec = self.bot_config.watch_max_sec
+            if max_sec > 0 and time.monotonic() - watch_start > max_sec:
+                logger.info(
+                    "Target is not bookable within %g s, stop watching",
+                    max_sec,
+                )
+                return False
+            poll_start = time.perf_counter()
+            try:
+                with self.session_lock:
+                    self.refresh(20)
+                    table = self.__find_ticket_table()
+                    new_fingerprint = self.__fingerprint_tickets(table)
+                    if new_fingerprint != fingerprint:
+                        detected_at = time.perf_counter()
+                        tickets = self.__scrape_tickets(table)
+                        if self.__is_target_bookable(tickets):
+                            logger.info("Target is bookable, book it")
+                            with self.__profile("book"):
+                                booked = self.__book_ticket(
+                                    tickets, detected_at
+                                )
+                            if booked:
+                                if self.recorder:
+                                    self.recorder.save()
+                                return True
+                            # the popup may have changed the page
+                            new_fingerprint = None
+                    # only remembered once handled, so that a failed
+                    # attempt is retried on the next poll
+                    fingerprint = new_fingerprint
+            except InvalidSessionIdException:
+                raise
+            except NoSuchElementException as e:
+                logger.error("Cannot find the element! %s", e)
+            except TimeoutException as e:
+                logger.error("Time ran out! %s", e)
+            except AssertionError as e:
+                logger.error("Assertion: %s", e)
+            except WebDriverException as e:
+                # e.g. a stale element right after the refresh
+                logger.error("Webdriver error! %s", e)
+
+            elapsed_sec = time.perf_counter() - poll_start
+            poll_count += 1
+            poll_sec += elapsed_sec
+            if poll_count % WATCH_REPORT_POLLS == 0:
+                logger.info(
+                    "Watched %d polls, %.1f ms per poll",
+                    poll_count,
+                    poll_sec / poll_count * 1000,
+                )
+
+            wait_sec = interval_sec - elapsed_sec
+            if wait_sec > 0:
+                if stop_event is not None:
+                    stop_event.wait(wait_sec)
+                else:
+                    time.sleep(wait_sec)
+        return False
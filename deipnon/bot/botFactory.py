@@ -1,6 +1,7 @@
 from deipnon.driver import WEB_DRIVER_TYPE
-from deipnon.config import BotConfig
+from deipnon.config import MODEL_FIELDS, BotConfig, diff_config
 from deipnon.utils import get_logger
+from deipnon.metrics import BROWSER_RESTARTS
 from deipnon.bot.bots import ChromeBot, EdgeBot, FirefoxBot
 from deipnon.bot.botBase import BotBase
 
@@ -11,15 +12,39 @@ logger = get_logger(__name__)
 class BotFactory:
 
     @classmethod
-    def new_bot(cls, bot_config: BotConfig) -> BotBase:
+    def new_bot(cls, bot_config: BotConfig, model=None) -> BotBase:
         bot_type = bot_config.web_driver_type
         logger.info("Use browser %s", bot_type)
         match bot_type:
             case WEB_DRIVER_TYPE.CHROME:
-                return ChromeBot(bot_config)
+                return ChromeBot(bot_config, model)
             case WEB_DRIVER_TYPE.EDGE:
-                return EdgeBot(bot_config)
+                return EdgeBot(bot_config, model)
             case WEB_DRIVER_TYPE.FIREFOX:
-                return FirefoxBot(bot_config)
+                return FirefoxBot(bot_config, model)
             case _:
                 raise RuntimeError(f"Unknown Web Driver Type {bot_type}")
+
+    @classmethod
+    def apply_config(cls, bot: BotBase, bot_config: BotConfig) -> BotBase:
+        """Apply a new config, return a new bot if the browser type changed"""
+        if bot_config.web_driver_type == bot.bot_config.web_driver_type:
+            bot.update_config(bot_config)
+            return bot
+
+        with bot.session_lock:
+            new_bot = cls.new_bot(bot_config, bot.model)
+            new_bot.own_model = bot.own_model
+            if new_bot.own_model and diff_config(
+                bot.bot_config, bot_config
+            ) & MODEL_FIELDS:
+                new_bot.initial_model()
+
+            if bot.driver is not None:
+                BROWSER_RESTARTS.inc()
+                logged_in = bot.logged_in
+                bot.close()
+                new_bot.initial_browser()
+                if logged_in:
+                    new_bot.login()
+        return new_bot
@@ -4,8 +4,8 @@ from deipnon.bot.botBase import BotBase
 
 
 class ChromeBot(BotBase):
-    def __init__(self, bot_config):
-        super().__init__(bot_config)
+    def __init__(self, bot_config, model=None):
+        super().__init__(bot_config, model)
         self.driver = None
 
     def initial_browser(self):
@@ -23,6 +23,10 @@ class ChromeBot(BotBase):
         # https://stackoverflow.com/questions/65080685/usb-usb-device-handle-win-cc1020-failed-to-read-descriptor-from-node-connectio
         option.add_experimental_option("excludeSwitches", ["enable-logging"])
 
+        if self.bot_config.record_dir:
+            # the recorder reads http exchanges from the performance log
+            option.set_capability("goog:loggingPrefs", {"performance": "ALL"})
+
         option.binary_location = web_driver_path
         if proxy_server:
             option.add_argument(f"--proxy-server={proxy_server}")
@@ -30,8 +34,8 @@ class ChromeBot(BotBase):
 
 
 class EdgeBot(BotBase):
-    def __init__(self, bot_config):
-        super().__init__(bot_config)
+    def __init__(self, bot_config, model=None):
+        super().__init__(bot_config, model)
         self.driver = None
 
     def initial_browser(self):
@@ -48,6 +52,9 @@ class EdgeBot(BotBase):
             option.add_argument("--headless=new")
         # https://stackoverflow.com/questions/65080685/usb-usb-device-handle-win-cc1020-failed-to-read-descriptor-from-node-connectio
         option.add_experimental_option("excludeSwitches", ["enable-logging"])
+        if self.bot_config.record_dir:
+            # the recorder reads http exchanges from the performance log
+            option.set_capability("ms:loggingPrefs", {"performance": "ALL"})
 
         if proxy_server:
             option.add_argument(f"--proxy-server={proxy_server}")
@@ -55,8 +62,8 @@ class EdgeBot(BotBase):
 
 
 class FirefoxBot(BotBase):
-    def __init__(self, bot_config):
-        super().__init__(bot_config)
+    def __init__(self, bot_config, model=None):
+        super().__init__(bot_config, model)
         self.driver = None
 
     def initial_browser(self):
@@ -0,0 +1,355 @@
+import os
+import sys
+import time
+import queue
+import getpass
+import secrets
+import argparse
+import platform
+import tempfile
+import threading
+from multiprocessing.connection import Client, Connection, Listener
+from typing import Optional, Union
+
+import msgspec
+from PIL import Image
+
+from deipnon.utils import get_logger
+
+logger = get_logger(__name__)
+
+AUTHKEY_ENV = "DEIPNON_CAPTCHA_AUTHKEY"
+AUTHKEY_FILE_NAME = "captcha.key"
+
+
+class CaptchaServiceError(RuntimeError):
+    """The captcha service is unreachable or failed, the call can be retried"""
+
+
+def get_runtime_dir() -> str:
+    """Folder only the current user can access, for the socket and the key"""
+    if platform.system() == "Windows":
+        base_folder = os.environ.get("LOCALAPPDATA", tempfile.gettempdir())
+        folder = os.path.join(base_folder, "deipnon")
+        os.makedirs(folder, exist_ok=True)
+        return folder
+
+    if os.environ.get("XDG_RUNTIME_DIR"):
+        folder = os.path.join(os.environ["XDG_RUNTIME_DIR"], "deipnon")
+    else:
+        folder = os.path.join(tempfile.gettempdir(), f"deipnon-{os.getuid()}")
+    os.makedirs(folder, mode=0o700, exist_ok=True)
+    # the folder may have been created by another user beforehand
+    stat = os.lstat(folder)
+    if stat.st_uid != os.getuid() or stat.st_mode & 0o077:
+        raise RuntimeError(f"{folder} is accessible by other users")
+    return folder
+
+
+def get_address(address: Optional[str] = None) -> str:
+    """The given address, or the default one if it is empty or default"""
+    if address and address != "default":
+        return address
+    if platform.system() == "Windows":
+        return rf"\\.\pipe\deipnon-captcha-{getpass.getuser()}"
+    return os.path.join(get_runtime_dir(), "captcha.sock")
+
+
+def load_authkey(create: bool = False) -> bytes:
+    """The key shared by the service and its clients.
+
+    It is read from $DEIPNON_CAPTCHA_AUTHKEY or else from a key file in the
+    runtime folder, which the service creates with a random key. Both sides
+    of a connection prove they know it, so neither talks to an impostor.
+    """
+    if os.environ.get(AUTHKEY_ENV):
+        return os.environ[AUTHKEY_ENV].encode("utf-8")
+
+    key_path = os.path.join(get_runtime_dir(), AUTHKEY_FILE_NAME)
+    if create and not os.path.exists(key_path):
+        # write aside and link, so that clients never read a partial key
+        tmp_path = f"{key_path}.{os.getpid()}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(secrets.token_hex(32))
+        try:
+            os.link(tmp_path, key_path)
+        except FileExistsError:
+            pass  # created by another service meanwhile
+        finally:
+            os.remove(tmp_path)
+    with open(key_path, "r", encoding="utf-8") as f:
+        return f.read().strip().encode("utf-8")
+
+
+class CaptchaService:
+    """Hold one captcha model and serve it to many bots over a local socket.
+
+    Requests which arrive within `batch_window_ms` of each other are merged
+    into a single batched inference.
+    """
+
+    class Request(msgspec.Struct):
+        images: list
+        topK: int
+        done: threading.Event
+        result: Optional[tuple[list[str], list]] = None
+        error: Optional[str] = None
+
+    def __init__(
+        self,
+        model_path: str,
+        address: Optional[str] = None,
+        authkey: Optional[bytes] = None,
+        batch_window_ms: float = 5,
+        max_batch_size: int = 16,
+        num_threads: int = 0,
+    ):
+        self.model_path = model_path
+        self.num_threads = num_threads
+        self.address = get_address(address)
+        self.authkey = authkey or load_authkey(create=True)
+        self.batch_window_sec = batch_window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.model = None
+        self.listener = None
+        self.pending: queue.Queue = queue.Queue()
+
+    def serve_forever(self):
+        # imported here so that clients never pay for loading the model
+        from deipnon.predict import (  # pylint: disable=import-outside-toplevel
+            Captcha,
+        )
+
+        assert self.model_path is not None and os.path.exists(
+            self.model_path
+        ), f"model_path ({self.model_path}) is invalid"
+
+        logger.info("Initial yolo model %s", self.model_path)
+        self.model = Captcha(self.model_path, self.num_threads)
+
+        # remove the stale unix socket left by a previous run
+        if not self.address.startswith("\\\\") and os.path.exists(
+            self.address
+        ):
+            os.remove(self.address)
+
+        self.listener = Listener(self.address, authkey=self.authkey)
+        logger.info("Captcha service is listening on %s", self.address)
+
+        threading.Thread(target=self.__batch_loop, daemon=True).start()
+        while True:
+            try:
+                conn = self.listener.accept()
+            except OSError:
+                break
+            threading.Thread(
+                target=self.__serve_client, args=(conn,), daemon=True
+            ).start()
+
+    def close(self):
+        if self.listener:
+            self.listener.close()
+            self.listener = None
+
+    def __serve_client(self, conn: Connection):
+        with conn:
+            while True:
+                try:
+                    images, topK = conn.recv()
+                except (EOFError, OSError):
+                    break
+
+                request = self.Request(
+                    images=images, topK=topK, done=threading.Event()
+                )
+                self.pending.put(request)
+                request.done.wait()
+
+                if request.error is not None:
+                    conn.send(("error", request.error))
+                else:
+                    conn.send(("ok", request.result))
+
+    def __batch_loop(self):
+        while True:
+            batch = [self.pending.get()]
+            batch_size = len(batch[0].images)
+
+            # gather the requests arriving in the same batch window
+            deadline = time.perf_counter() + self.batch_window_sec
+            while batch_size < self.max_batch_size:
+                timeout_sec = deadline - time.perf_counter()
+                if timeout_sec <= 0:
+                    break
+                try:
+                    request = self.pending.get(timeout=timeout_sec)
+                except queue.Empty:
+                    break
+                batch.append(request)
+                batch_size += len(request.images)
+
+            # requests with different topK cannot share one inference
+            groups: dict[int, list[CaptchaService.Request]] = {}
+            for request in batch:
+                groups.setdefault(request.topK, []).append(request)
+            for topK, requests in groups.items():
+                self.__run_batch(requests, topK)
+
+    def __run_batch(self, requests: list[Request], topK: int):
+        images = [image for request in requests for image in request.images]
+        logger.debug(
+            "Batch %d images from %d requests", len(images), len(requests)
+        )
+        try:
+            result_str_list, data_list = self.model.predict(
+                images, topK=topK, detail=True
+            )
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            logger.error("Captcha inference failed: %s", e)
+            for request in requests:
+                request.error = repr(e)
+                request.done.set()
+            return
+
+        offset = 0
+        for request in requests:
+            n = len(request.images)
+            request.result = (
+                result_str_list[offset : offset + n],
+                data_list[offset : offset + n],
+            )
+            offset += n
+            request.done.set()
+
+
+class CaptchaClient:
+    """Thin client of CaptchaService, can be used in place of Captcha"""
+
+    def __init__(
+        self,
+        address: Optional[str] = None,
+        authkey: Optional[bytes] = None,
+        connect_timeout_sec: float = 30,
+    ):
+        self.address = get_address(address)
+        self.authkey = authkey
+        self.connect_timeout_sec = connect_timeout_sec
+        self.conn = None
+        self.lock = threading.Lock()
+        with self.lock:
+            self.__connect()
+
+    def __connect(self):
+        # the service may still be loading its model or writing its key
+        deadline = time.monotonic() + self.connect_timeout_sec
+        while True:
+            try:
+                authkey = self.authkey or load_authkey()
+                self.conn = Client(self.address, authkey=authkey)
+                break
+            except (FileNotFoundError, ConnectionRefusedError) as e:
+                if time.monotonic() > deadline:
+                    raise CaptchaServiceError(
+                        f"Cannot connect to captcha service ({self.address})"
+                    ) from e
+                time.sleep(0.2)
+        logger.info("Connect to captcha service %s", self.address)
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+    def release(self):
+        """The model lives in the service, nothing to free here"""
+
+    def predict(
+        self,
+        images: Union[Image.Image, list[Image.Image]],
+        topK=5,
+        detail: bool = False,
+    ) -> Union[str, list[str], tuple[str, list], list[tuple[str, list]]]:
+        if isinstance(images, Image.Image):
+            input_data = [images]
+        else:
+            input_data = list(images)
+
+        with self.lock:
+            # reconnect lazily after the service has been restarted
+            if self.conn is None:
+                self.__connect()
+            try:
+                self.conn.send((input_data, topK))
+                status, payload = self.conn.recv()
+            except (EOFError, OSError) as e:
+                self.conn.close()
+                self.conn = None
+                raise CaptchaServiceError(
+                    f"Lost captcha service ({self.address}): {e!r}"
+                ) from e
+        if status != "ok":
+            raise CaptchaServiceError(f"Captcha service error: {payload}")
+        result_str_list, data_list = payload
+
+        if isinstance(images, Image.Image):
+            return (
+                result_str_list[0]
+                if detail is False
+                else (result_str_list[0], data_list[0])
+            )
+        else:
+            return (
+                result_str_list
+                if detail is False
+                else (result_str_list, data_list)
+            )
+
+
+def serve(model_path: str, address: Optional[str] = None, **kwargs):
+    """Run a captcha service in the current process until it is closed"""
+    CaptchaService(model_path, address, **kwargs).serve_forever()
+
+
+def main(argv: Optional[list[str]] = None):
+    parser = argparse.ArgumentParser(
+        description="Shared captcha inference service"
+    )
+    parser.add_argument("model_path", help="path to captcha model")
+    parser.add_argument(
+        "--address",
+        default=None,
+        help="unix socket or pipe (default: in a folder private to the user)",
+    )
+    parser.add_argument(
+        "--batch-window-ms",
+        type=float,
+        default=5,
+        help="time to wait for more requests before inference",
+    )
+    parser.add_argument(
+        "--max-batch-size",
+        type=int,
+        default=16,
+        help="max number of images in one inference",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=0,
+        help="max threads of captcha inference, 0 for default",
+    )
+    args = parser.parse_args(argv)
+
+    serve(
+        args.model_path,
+        args.address,
+        batch_window_ms=args.batch_window_ms,
+        max_batch_size=args.max_batch_size,
+        num_threads=args.threads,
+    )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
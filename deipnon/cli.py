@@ -0,0 +1,221 @@
+import signal
+import argparse
+from typing import Optional
+
+import msgspec
+
+from deipnon.utils import get_config_file_path, get_logger
+from deipnon.config import BotConfig, merge_config, read_from_toml_file
+from deipnon.configWatcher import ConfigWatcher
+from deipnon.driver import check_webdriver, download_webdriver
+from deipnon.jobRunner import JobResult, JobRunner
+from deipnon.replay import ReplayServer
+from deipnon.captchaService import serve as serve_captcha
+
+logger = get_logger(__name__)
+
+EXIT_OK = 0
+EXIT_BOOK_FAILED = 1
+# argparse exits with 2 on a bad command line
+EXIT_USAGE_ERROR = 2
+EXIT_CONFIG_ERROR = 3
+EXIT_SETUP_ERROR = 4
+
+EXIT_CODES_HELP = f"""exit codes:
+  {EXIT_OK}  every job has been booked
+  {EXIT_BOOK_FAILED}  some job has not been booked
+  {EXIT_USAGE_ERROR}  invalid command line
+  {EXIT_CONFIG_ERROR}  invalid config file
+  {EXIT_SETUP_ERROR}  webdriver or captcha model cannot be set up
+"""
+
+
+def exit_code_of(results: list[JobResult]) -> int:
+    """Exit code which tells whether every job has been booked"""
+    if len(results) > 0 and all(result.booked for result in results):
+        return EXIT_OK
+    return EXIT_BOOK_FAILED
+
+
+def prepare_webdriver(config: BotConfig):
+    if not check_webdriver(config.web_driver_path):
+        config.web_driver_path = download_webdriver(
+            config.web_driver_type, config.web_driver_path
+        )
+
+
+def watch_config(config_path: str, runner: JobRunner) -> ConfigWatcher:
+    """Apply the edits of the config file to the running jobs"""
+
+    def on_change(new_config: BotConfig, changed: set[str]):
+        # keep the downloaded webdriver path unless the file changes it
+        config = merge_config(runner.bot_config, new_config, changed)
+        if changed & {"web_driver_type", "web_driver_path"}:
+            prepare_webdriver(config)
+        runner.update_config(config)
+
+    watcher = ConfigWatcher(config_path, on_change)
+    watcher.start()
+    return watcher
+
+
+def book_now(runner: JobRunner) -> int:
+    return exit_code_of(runner.run(immediate=True))
+
+
+def run_schedule(runner: JobRunner) -> int:
+    return exit_code_of(runner.run())
+
+
+def run_daemon(runner: JobRunner) -> int:
+    """Run the scheduled jobs every day until being stopped"""
+    exit_code = EXIT_OK
+    while not runner.stop_event.is_set():
+        results = runner.run()
+        if runner.stop_event.is_set():
+            break
+        exit_code = exit_code_of(results)
+    return exit_code
+
+
+def run_captcha_service(config: BotConfig) -> int:
+    """Serve the model of the config to the bots on captcha_service"""
+    try:
+        serve_captcha(
+            config.model_path,
+            config.captcha_service,
+            num_threads=config.inference_threads,
+        )
+    except KeyboardInterrupt:
+        pass
+    return EXIT_OK
+
+
+def run_replay(archive: str, host: str, port: int, speed: float) -> int:
+    server = ReplayServer(archive, host, port, speed)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+    return EXIT_OK
+
+
+def add_common_arguments(
+    parser: argparse.ArgumentParser, default=None, watch_default=False
+):
+    parser.add_argument(
+        "-c",
+        "--config",
+        default=default,
+        help="path to config file (default: $CONFIG_PATH or config.toml)",
+    )
+    parser.add_argument(
+        "-w",
+        "--watch",
+        action="store_true",
+        default=watch_default,
+        help="apply edits of the config file without restarting",
+    )
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="deipnon",
+        description="Book tickets without the GUI",
+        epilog=EXIT_CODES_HELP,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    add_common_arguments(parser)
+    # accept the options after the subcommand too, without overriding the
+    # ones given before it when they are omitted
+    common_parser = argparse.ArgumentParser(add_help=False)
+    add_common_arguments(
+        common_parser,
+        default=argparse.SUPPRESS,
+        watch_default=argparse.SUPPRESS,
+    )
+
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser(
+        "book-now", parents=[common_parser], help="log in and book right now"
+    )
+    subparsers.add_parser(
+        "schedule",
+        parents=[common_parser],
+        help="log in and book at the configured time once",
+    )
+    subparsers.add_parser(
+        "daemon",
+        parents=[common_parser],
+        help="log in and book at the configured time every day",
+    )
+    subparsers.add_parser(
+        "captcha-service",
+        parents=[common_parser],
+        help="share one captcha model with the bots of other processes",
+    )
+    replay_parser = subparsers.add_parser(
+        "replay", help="serve a recorded session for offline runs"
+    )
+    replay_parser.add_argument("archive", help="path to recorded session")
+    replay_parser.add_argument("--host", default="127.0.0.1")
+    replay_parser.add_argument("--port", type=int, default=8000)
+    replay_parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="divide the recorded response delays by this factor",
+    )
+    args = parser.parse_args(argv)
+
+    if args.command == "replay":
+        return run_replay(args.archive, args.host, args.port, args.speed)
+
+    config_path = args.config or get_config_file_path(use_argv=False)
+    try:
+        config = read_from_toml_file(config_path)
+    except (AssertionError, OSError, msgspec.DecodeError) as e:
+        logger.error("Invalid config: %s", e)
+        return EXIT_CONFIG_ERROR
+
+    if args.command == "captcha-service":
+        try:
+            return run_captcha_service(config)
+        except AssertionError as e:
+            logger.error("Invalid config: %s", e)
+            return EXIT_CONFIG_ERROR
+
+    # tell a broken setup apart from a failed booking
+    try:
+        prepare_webdriver(config)
+        runner = JobRunner(config)
+    except AssertionError as e:
+        logger.error("Invalid config: %s", e)
+        return EXIT_CONFIG_ERROR
+    except (RuntimeError, OSError) as e:
+        # missing webdriver asset, offline without a cached manifest, ...
+        # requests errors are OSError and NotImplementedError is RuntimeError
+        logger.error("Setup failed: %r", e)
+        return EXIT_SETUP_ERROR
+
+    if args.watch:
+        watch_config(config_path, runner)
+
+    def on_signal(signum, _frame):
+        logger.info("Receive signal %s, stopping", signal.Signals(signum).name)
+        runner.stop()
+
+    signal.signal(signal.SIGINT, on_signal)
+    signal.signal(signal.SIGTERM, on_signal)
+
+    match args.command:
+        case "book-now":
+            return book_now(runner)
+        case "schedule":
+            return run_schedule(runner)
+        case "daemon":
+            return run_daemon(runner)
+        case _:
+            raise RuntimeError(f"Unknown command {args.command}")
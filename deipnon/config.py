@@ -1,7 +1,36 @@
 import msgspec
 import os
+from typing import Annotated
 
 from deipnon.driver import WEB_DRIVER_TYPE
+from deipnon.profiler import PROFILE_MODE
+
+# an empty name would match the first ticket or item by substring
+TargetName = Annotated[str, msgspec.Meta(min_length=1)]
+
+
+class BookTarget(msgspec.Struct):
+    """An acceptable ticket and item, matched by substring"""
+
+    ticket_name: TargetName
+    ticket_item_name: TargetName
+
+
+class JobConfig(msgspec.Struct):
+    """Config for one booking job, empty optional fields use BotConfig.
+
+    fallback_targets is not inherited, a job only falls back to its own.
+    """
+
+    ticket_name: TargetName
+    ticket_item_name: TargetName
+
+    name: str = ""
+    start_time: str = ""
+    pre_login_time: str = ""
+    account: str = ""
+    password: str = ""
+    fallback_targets: list[BookTarget] = []
 
 
 class BotConfig(msgspec.Struct):
@@ -24,6 +53,90 @@ class BotConfig(msgspec.Struct):
     web_driver_path: str = "./chrome-win64/chrome.exe"
     model_path: str = "./models/yolo11m_fake_5000_real_550.pt"
     proxy_server: str = ""
+    captcha_service: str = ""
+    max_browsers: int = 1
+    lean_mode: bool = False
+    inference_threads: int = 0
+    resource_report_sec: int = 0
+    watch_interval_sec: float = 0
+    watch_max_sec: float = 3600
+    record_dir: str = ""
+    metrics_port: int = 0
+    profile_dir: str = ""
+    profile_mode: PROFILE_MODE = PROFILE_MODE.SAMPLE
+    fallback_targets: list[BookTarget] = []
+    jobs: list[JobConfig] = []
+
+
+# changing these fields needs to reload the model or restart the browser,
+# the others can be applied to a running bot
+MODEL_FIELDS = frozenset(("model_path", "captcha_service"))
+BROWSER_FIELDS = frozenset(
+    ("web_driver_type", "web_driver_path", "proxy_server", "headless")
+)
+
+
+def diff_config(old: BotConfig, new: BotConfig) -> set[str]:
+    """Names of the fields whose values are different"""
+    old_fields = msgspec.structs.asdict(old)
+    new_fields = msgspec.structs.asdict(new)
+    return {
+        name for name in new_fields if old_fields[name] != new_fields[name]
+    }
+
+
+def merge_config(
+    config: BotConfig, new_config: BotConfig, changed: set[str]
+) -> BotConfig:
+    """Copy the changed fields of new_config onto config"""
+    return msgspec.structs.replace(
+        config, **{name: getattr(new_config, name) for name in changed}
+    )
+
+
+def get_targets(config: BotConfig) -> list[BookTarget]:
+    """The acceptable targets in the order of preference"""
+    return [
+        BookTarget(
+            ticket_name=config.ticket_name,
+            ticket_item_name=config.ticket_item_name,
+        )
+    ] + list(config.fallback_targets)
+
+
+def get_jobs(config: BotConfig) -> list[JobConfig]:
+    """List the jobs of the config, the top-level target is the only job if no jobs given"""
+    if len(config.jobs) > 0:
+        return config.jobs
+    return [
+        JobConfig(
+            ticket_name=config.ticket_name,
+            ticket_item_name=config.ticket_item_name,
+            start_time=config.start_time,
+            name=config.ticket_name,
+            pre_login_time=config.pre_login_time,
+            account=config.account,
+            password=config.password,
+            fallback_targets=config.fallback_targets,
+        )
+    ]
+
+
+def bot_config_for_job(config: BotConfig, job: JobConfig) -> BotConfig:
+    """Build the bot config to run a single job"""
+    return msgspec.structs.replace(
+        config,
+        ticket_name=job.ticket_name,
+        ticket_item_name=job.ticket_item_name,
+        start_time=job.start_time or config.start_time,
+        pre_login_time=job.pre_login_time or config.pre_login_time,
+        account=job.account or config.account,
+        password=job.password or config.password,
+        # the top-level fallbacks belong to the top-level target, get_jobs
+        # only gives them to the implicit job
+        fallback_targets=job.fallback_targets,
+        jobs=[],
+    )
 
 
 def read_from_toml_file(toml_path: str) -> BotConfig:
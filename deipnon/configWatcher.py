@@ -0,0 +1,70 @@
+import os
+import threading
+from typing import Callable, Optional
+
+import msgspec
+
+from deipnon.utils import get_logger
+from deipnon.config import BotConfig, diff_config, read_from_toml_file
+
+logger = get_logger(__name__)
+
+
+class ConfigWatcher:
+    """Poll the config file and report the fields changed by each edit.
+
+    on_change receives the newly decoded config and the names of the changed
+    fields. Edits which cannot be decoded are ignored until fixed.
+    """
+
+    def __init__(
+        self,
+        config_path: str,
+        on_change: Callable[[BotConfig, set[str]], None],
+        interval_sec: float = 1.0,
+    ):
+        self.config_path = config_path
+        self.on_change = on_change
+        self.interval_sec = interval_sec
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.config = read_from_toml_file(config_path)
+        self.file_stat = self.__get_file_stat()
+
+    def start(self):
+        logger.info("Watch config file %s", self.config_path)
+        self.thread = threading.Thread(target=self.__watch, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def __get_file_stat(self) -> Optional[tuple[int, int]]:
+        try:
+            stat = os.stat(self.config_path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def __watch(self):
+        while not self.stop_event.wait(self.interval_sec):
+            file_stat = self.__get_file_stat()
+            if file_stat is None or file_stat == self.file_stat:
+                continue
+            self.file_stat = file_stat
+
+            try:
+                config = read_from_toml_file(self.config_path)
+            except (AssertionError, OSError, msgspec.DecodeError) as e:
+                logger.error("Ignore invalid config: %s", e)
+                continue
+
+            changed = diff_config(self.config, config)
+            self.config = config
+            if len(changed) == 0:
+                continue
+            logger.info("Reload config: %s", ", ".join(sorted(changed)))
+            try:
+                self.on_change(config, changed)
+            except Exception as e:  # pylint: disable=broad-except
+                logger.error("Apply config failed: %s", e)
@@ -1,9 +1,15 @@
 import os
 import json
+import time
+import shutil
+import hashlib
+import tarfile
 import zipfile
 import platform
+import tempfile
 from pathlib import Path
 from enum import Enum
+from typing import Optional
 
 import requests
 
@@ -11,6 +17,12 @@ from .utils import get_logger, download_file
 
 logger = get_logger(__name__)
 
+CHROME_MANIFEST_URL = "https://googlechromelabs.github.io/chrome-for-testing/last-known-good-versions-with-downloads.json"
+FIREFOX_MANIFEST_URL = (
+    "https://api.github.com/repos/mozilla/geckodriver/releases/latest"
+)
+MANIFEST_CACHE_TTL_SEC = 6 * 60 * 60
+
 
 class WEB_DRIVER_TYPE(Enum):
     CHROME = "chrome"
@@ -23,80 +35,228 @@ def check_webdriver(webdriver_path: str):
     return os.path.exists(webdriver_path)
 
 
-def download_webdriver(web_driver_type: WEB_DRIVER_TYPE, webdriver_path: str):
-    webdriver_folder = os.path.dirname(os.path.normpath(webdriver_path))
-    logger.info("Auto downloading webdriver to %s", webdriver_folder)
-    if len(webdriver_folder) > 0 and not os.path.exists(
-        webdriver_folder
-    ):  # webdriver_folder may be "" for cwd
-        os.makedirs(webdriver_folder)
-
+def get_platform() -> str:
+    """platform name used by chrome-for-testing and geckodriver releases"""
     system = platform.system()
-    if system != "Windows":
-        raise RuntimeError(f"{system} not supported!")
+    machine = platform.machine().lower()
+    if system == "Windows" and machine in ("amd64", "x86_64"):
+        return "win64"
+    if system == "Linux" and machine in ("amd64", "x86_64"):
+        return "linux64"
+    raise RuntimeError(f"{system} ({machine}) not supported!")
 
-    if web_driver_type == WEB_DRIVER_TYPE.CHROME:
-        CHROME_WEBDRIVER_LIST_URL = "https://googlechromelabs.github.io/chrome-for-testing/known-good-versions-with-downloads.json"
+
+def fetch_manifest(
+    url: str, cache_folder: str, ttl_sec: float = MANIFEST_CACHE_TTL_SEC
+) -> tuple[dict, bool]:
+    """Fetch a json manifest, cached on disk for ttl_sec.
+
+    Return the manifest and whether ssl verification succeeded.
+    """
+    cache_path = os.path.join(
+        cache_folder, hashlib.sha1(url.encode()).hexdigest() + ".json"
+    )
+    cache = None
+    if os.path.exists(cache_path):
+        with open(cache_path, "r", encoding="utf-8") as f:
+            cache = json.load(f)
+        if time.time() - cache["fetched_at"] < ttl_sec:
+            logger.debug("Use cached manifest of %s", url)
+            return cache["data"], cache["verify"]
+
+    try:
         try:
-            resp = requests.get(CHROME_WEBDRIVER_LIST_URL, timeout=10)
+            resp = requests.get(url, timeout=10)
             enable_verify = True
         except requests.exceptions.SSLError:
-            resp = requests.get(
-                CHROME_WEBDRIVER_LIST_URL, timeout=10, verify=False
-            )
+            resp = requests.get(url, timeout=10, verify=False)
             enable_verify = False
-        webdriver_list = json.loads(resp.text)
+        resp.raise_for_status()
+        data = resp.json()
+    except requests.exceptions.RequestException as e:
+        if cache is None:
+            raise
+        logger.warning("Fetch manifest failed (%s), use the stale one", e)
+        return cache["data"], cache["verify"]
+
+    os.makedirs(cache_folder, exist_ok=True)
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(
+            {"fetched_at": time.time(), "verify": enable_verify, "data": data},
+            f,
+        )
+    os.replace(tmp_path, cache_path)
+    return data, enable_verify
+
+
+def verify_archive(
+    file_path: str,
+    expected_size: Optional[int] = None,
+    expected_sha256: Optional[str] = None,
+):
+    """Raise RuntimeError if the downloaded archive is broken"""
+    size = os.path.getsize(file_path)
+    if expected_size is not None and size != expected_size:
+        raise RuntimeError(
+            f"Size mismatch of {file_path}: {size} != {expected_size}"
+        )
+
+    if expected_sha256 is not None:
+        sha256 = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha256.update(chunk)
+        if sha256.hexdigest() != expected_sha256.lower():
+            raise RuntimeError(f"Checksum mismatch of {file_path}")
+
+    if zipfile.is_zipfile(file_path):
+        with zipfile.ZipFile(file_path, "r") as zip_ref:
+            bad_file = zip_ref.testzip()
+        if bad_file is not None:
+            raise RuntimeError(f"Corrupted file {bad_file} in {file_path}")
+    else:
+        try:
+            with tarfile.open(file_path, "r:*") as tar_ref:
+                for _ in tar_ref:
+                    pass
+        except tarfile.TarError as e:
+            raise RuntimeError(f"Corrupted archive {file_path}") from e
+
+
+def unpack_archive(file_path: str, target_folder: str):
+    """Unpack into target_folder atomically, it exists only if complete"""
+    parent_folder = os.path.dirname(os.path.normpath(target_folder))
+    os.makedirs(parent_folder, exist_ok=True)
+    tmp_folder = tempfile.mkdtemp(prefix=".unpack-", dir=parent_folder)
+    try:
+        if zipfile.is_zipfile(file_path):
+            with zipfile.ZipFile(file_path, "r") as zip_ref:
+                for info in zip_ref.infolist():
+                    extracted_path = zip_ref.extract(info, tmp_folder)
+                    # zipfile drops the unix permissions
+                    mode = (info.external_attr >> 16) & 0o777
+                    if mode:
+                        os.chmod(extracted_path, mode)
+        else:
+            with tarfile.open(file_path, "r:*") as tar_ref:
+                tar_ref.extractall(tmp_folder, filter="data")
+        try:
+            os.replace(tmp_folder, target_folder)
+        except OSError:
+            # another process has unpacked the same version meanwhile
+            if not os.path.exists(target_folder):
+                raise
+            shutil.rmtree(tmp_folder, ignore_errors=True)
+    except BaseException:
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+        raise
+
+
+def provision(
+    store_folder: str,
+    version: str,
+    platform_name: str,
+    download_url: str,
+    binary_name: str,
+    verify: bool = True,
+    expected_size: Optional[int] = None,
+    expected_sha256: Optional[str] = None,
+) -> str:
+    """Make sure store_folder/version/platform holds the binary"""
+    target_folder = os.path.join(store_folder, version, platform_name)
+    if not os.path.exists(target_folder):
+        logger.info("Download %s from %s", binary_name, download_url)
+        archive_name = download_url.rsplit("/", maxsplit=1)[-1]
+        archive_path = os.path.join(store_folder, version, archive_name)
+        os.makedirs(os.path.dirname(archive_path), exist_ok=True)
+        download_file(download_url, archive_path, verify)
+        try:
+            verify_archive(archive_path, expected_size, expected_sha256)
+        except RuntimeError:
+            # do not resume from a broken file next time
+            os.remove(archive_path)
+            raise
+        unpack_archive(archive_path, target_folder)
+        os.remove(archive_path)
+    else:
+        logger.info("Use cached %s %s", binary_name, version)
 
-        target_version = webdriver_list["versions"][0]
+    for path in Path(target_folder).rglob(binary_name):
+        if path.is_file():
+            return path.as_posix()
+    raise RuntimeError(f"Cannot find {binary_name} in {target_folder}")
+
+
+def download_webdriver(
+    web_driver_type: WEB_DRIVER_TYPE,
+    webdriver_path: str,
+    manifest_url: Optional[str] = None,
+):
+    webdriver_folder = os.path.dirname(os.path.normpath(webdriver_path))
+    logger.info("Auto downloading webdriver to %s", webdriver_folder)
+    cache_folder = os.path.join(webdriver_folder, ".manifests")
+    platform_name = get_platform()
+    suffix = ".exe" if platform_name.startswith("win") else ""
+
+    if web_driver_type == WEB_DRIVER_TYPE.CHROME:
+        manifest, enable_verify = fetch_manifest(
+            manifest_url or CHROME_MANIFEST_URL, cache_folder
+        )
+        target_version = manifest["channels"]["Stable"]
         logger.info("Webdriver version: %s", target_version["version"])
 
         download_url = None
         for item in target_version["downloads"]["chrome"]:
-            if item["platform"] == "win64":
+            if item["platform"] == platform_name:
                 download_url = item["url"]
                 break
+        if download_url is None:
+            raise RuntimeError(f"No chrome for {platform_name}")
 
-        webdriver_file_name = os.path.join(webdriver_folder, "webdriver.zip")
-        download_file(download_url, webdriver_file_name, enable_verify)
-
-        with zipfile.ZipFile(webdriver_file_name, "r") as zip_ref:
-            zip_ref.extractall(webdriver_folder)
-
-        for path in Path(webdriver_folder).rglob("chrome.exe"):
-            return path.as_posix()
+        return provision(
+            os.path.join(webdriver_folder, "chrome"),
+            target_version["version"],
+            platform_name,
+            download_url,
+            "chrome" + suffix,
+            enable_verify,
+        )
     elif web_driver_type == WEB_DRIVER_TYPE.EDGE:
         logger.error("Please downalod and install webdriver manually")
         raise NotImplementedError
 
     elif web_driver_type == WEB_DRIVER_TYPE.FIREFOX:
-        FIREFOX_WEBDRIVER_LIST_URL = (
-            "https://api.github.com/repos/mozilla/geckodriver/releases/latest"
+        manifest, enable_verify = fetch_manifest(
+            manifest_url or FIREFOX_MANIFEST_URL, cache_folder
         )
-        try:
-            resp = requests.get(FIREFOX_WEBDRIVER_LIST_URL, timeout=10)
-            enable_verify = True
-        except requests.exceptions.SSLError:
-            resp = requests.get(
-                FIREFOX_WEBDRIVER_LIST_URL, timeout=10, verify=False
-            )
-            enable_verify = False
-        webdriver_list = json.loads(resp.text)
+        logger.info("Webdriver version: %s", manifest["tag_name"])
 
-        logger.info("Webdriver version: %s", webdriver_list["tag_name"])
-
-        download_url = None
-        for item in webdriver_list["assets"]:
-            if "win64" in item["name"]:
-                download_url = item["browser_download_url"]
+        asset = None
+        for item in manifest["assets"]:
+            if item["name"].endswith(
+                (f"{platform_name}.zip", f"{platform_name}.tar.gz")
+            ):
+                asset = item
                 break
+        if asset is None:
+            raise RuntimeError(f"No geckodriver for {platform_name}")
 
-        webdriver_file_name = os.path.join(webdriver_folder, "webdriver.zip")
-        download_file(download_url, webdriver_file_name, enable_verify)
-
-        with zipfile.ZipFile(webdriver_file_name, "r") as zip_ref:
-            zip_ref.extractall(webdriver_folder)
+        # github reports digests like "sha256:<hex>" for newer assets
+        expected_sha256 = None
+        digest = asset.get("digest") or ""
+        if digest.startswith("sha256:"):
+            expected_sha256 = digest.split(":", maxsplit=1)[1]
 
-        for path in Path(webdriver_folder).rglob("geckodriver.exe"):
-            return path.as_posix()
+        return provision(
+            os.path.join(webdriver_folder, "geckodriver"),
+            manifest["tag_name"],
+            platform_name,
+            asset["browser_download_url"],
+            "geckodriver" + suffix,
+            enable_verify,
+            expected_size=asset.get("size"),
+            expected_sha256=expected_sha256,
+        )
 
     raise RuntimeError("Download file error")
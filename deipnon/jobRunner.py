@@ -0,0 +1,424 @@
+import time
+import datetime
+import threading
+from typing import Callable, Optional
+from concurrent.futures import ThreadPoolExecutor
+
+import msgspec
+
+from deipnon.config import (
+    MODEL_FIELDS,
+    BotConfig,
+    JobConfig,
+    bot_config_for_job,
+    diff_config,
+    get_jobs,
+)
+from deipnon.utils import get_logger
+from deipnon.metrics import BROWSER_RESTARTS, start_metrics_server
+from deipnon.resourceMonitor import ResourceMonitor
+from deipnon.scheduler import OneShotScheduler, next_occurrence
+from deipnon.bot.botBase import BotBase, load_captcha_model
+from deipnon.bot.botFactory import BotFactory
+
+logger = get_logger(__name__)
+
+# an account gives its browser back when its next login is further away
+BROWSER_IDLE_RELEASE_SEC = 10 * 60
+
+
+class JobResult(msgspec.Struct):
+    name: str
+    account: str
+    ticket_name: str
+    ticket_item_name: str
+    logged_in: bool = False
+    booked: bool = False
+    error: str = ""
+    duration_sec: float = 0.0
+
+
+class JobRunner:
+    """Run the jobs of a config concurrently.
+
+    Jobs of the same account share one browser and one login and run in the
+    order of their start time. At most `max_browsers` browsers are alive at
+    the same time, an account gives its browser back while its next job is
+    far away. All bots share one captcha model.
+    """
+
+    class Session(msgspec.Struct):
+        bot: BotBase
+        job_index: int
+        scheduler: Optional[OneShotScheduler] = None
+        # serializes config changes of the bot, which may wait for the bot
+        # to finish a login, so never hold sessions_lock while taking it
+        update_lock: threading.Lock = msgspec.field(
+            default_factory=threading.Lock
+        )
+
+    def __init__(self, bot_config: BotConfig):
+        self.bot_config = bot_config
+        self.stop_event = threading.Event()
+        self.sessions: dict[int, JobRunner.Session] = {}
+        self.sessions_lock = threading.RLock()
+        self.browser_slots = threading.BoundedSemaphore(
+            max(1, bot_config.max_browsers)
+        )
+
+        if bot_config.metrics_port > 0:
+            start_metrics_server(bot_config.metrics_port)
+
+        # clients of the captcha service are cheap, each bot owns one so
+        # that their requests can be batched by the service
+        self.model = None
+        if not bot_config.captcha_service:
+            self.model = load_captcha_model(bot_config)
+
+    def stop(self):
+        self.stop_event.set()
+
+    def close(self):
+        """Stop the jobs and quit every browser"""
+        self.stop()
+        with self.sessions_lock:
+            bots = [session.bot for session in self.sessions.values()]
+        for bot in bots:
+            bot.close()
+
+    def run(self, immediate: bool = False) -> list[JobResult]:
+        """Run all jobs, book now if immediate else at their start time"""
+        self.stop_event.clear()
+        jobs = get_jobs(self.bot_config)
+
+        resource_monitor = None
+        if self.bot_config.resource_report_sec > 0:
+            resource_monitor = ResourceMonitor(
+                self.bot_config.resource_report_sec
+            )
+            resource_monitor.start()
+
+        account_jobs: dict[str, list[tuple[int, JobConfig]]] = {}
+        for idx, job in enumerate(jobs):
+            account = job.account or self.bot_config.account
+            account_jobs.setdefault(account, []).append((idx, job))
+
+        results: list[JobResult] = [None] * len(jobs)
+        try:
+            with ThreadPoolExecutor(
+                max_workers=len(account_jobs),
+                thread_name_prefix="deipnon-job",
+            ) as executor:
+                futures = [
+                    executor.submit(
+                        self.__run_account, indexed_jobs, immediate
+                    )
+                    for indexed_jobs in account_jobs.values()
+                ]
+                for future in futures:
+                    for idx, result in future.result():
+                        results[idx] = result
+        finally:
+            if resource_monitor is not None:
+                resource_monitor.report()
+                resource_monitor.stop()
+
+        for result in results:
+            logger.info(
+                "Job %s: %s",
+                result.name,
+                "booked" if result.booked else f"failed {result.error}",
+            )
+        return results
+
+    def update_config(self, bot_config: BotConfig):
+        """Apply a new config to the running jobs.
+
+        Target and timing changes move the pending login/book of the current
+        job of every account, the model and browsers are only rebuilt if
+        their fields changed.
+        """
+        with self.sessions_lock:
+            changed = diff_config(self.bot_config, bot_config)
+            self.bot_config = bot_config
+        if len(changed) == 0:
+            return
+
+        model = self.model
+        if changed & MODEL_FIELDS:
+            model = None
+            if not bot_config.captcha_service:
+                model = load_captcha_model(bot_config)
+
+        # only collect the sessions under the lock, applying a config waits
+        # for the bot which may be busy logging in
+        updates = []
+        with self.sessions_lock:
+            self.model = model
+            jobs = get_jobs(bot_config)
+            for session in self.sessions.values():
+                if session.job_index >= len(jobs):
+                    continue
+                job_config = bot_config_for_job(
+                    bot_config, jobs[session.job_index]
+                )
+                updates.append((session, job_config))
+
+        for session, job_config in updates:
+            with session.update_lock:
+                # the runner swaps the shared model, a bot connects its own
+                # captcha service client when it applies the config
+                if changed & MODEL_FIELDS:
+                    if model is not None:
+                        session.bot.initial_model(model)
+                    else:
+                        session.bot.own_model = True
+                bot = BotFactory.apply_config(session.bot, job_config)
+                with self.sessions_lock:
+                    session.bot = bot
+
+            scheduler = session.scheduler
+            if scheduler is not None:
+                scheduler.reschedule("login", job_config.pre_login_time)
+                scheduler.reschedule("book", job_config.start_time)
+
+    def __acquire_browser_slot(self, account: str) -> bool:
+        """Wait for a free browser, return False if stopped meanwhile"""
+        if self.browser_slots.acquire(blocking=False):
+            return True
+        logger.info(
+            "Account %s waits for a free browser, %d in use",
+            account,
+            self.bot_config.max_browsers,
+        )
+        while not self.stop_event.is_set():
+            if self.browser_slots.acquire(timeout=1):
+                return True
+        return False
+
+    def __schedule_job(
+        self,
+        session: Session,
+        job_config: BotConfig,
+        login_routine: Callable,
+        book_routine: Callable,
+    ) -> bool:
+        pre_login_time = job_config.pre_login_time
+        start_time = job_config.start_time
+        # log in right now if it is already too late
+        login_now = not session.bot.logged_in and next_occurrence(
+            pre_login_time
+        ) > next_occurrence(start_time)
+        scheduler = OneShotScheduler()
+
+        if job_config.watch_interval_sec > 0:
+            # tickets may be released before the start time, so watch
+            # right after logging in
+            def watch_routine():
+                login_routine()
+                book_routine()
+
+            if session.bot.logged_in or login_now:
+                watch_routine()
+                return not self.stop_event.is_set()
+            scheduler.add("login", pre_login_time, watch_routine)
+        else:
+            if login_now:
+                login_routine()
+            elif not session.bot.logged_in:
+                scheduler.add("login", pre_login_time, login_routine)
+            scheduler.add("book", start_time, book_routine)
+
+        session.scheduler = scheduler
+        try:
+            return scheduler.run(self.stop_event)
+        finally:
+            session.scheduler = None
+
+    def __current_job(self, idx: int) -> Optional[JobConfig]:
+        """The idx-th job of the current config, None if it was removed"""
+        jobs = get_jobs(self.bot_config)
+        return jobs[idx] if idx < len(jobs) else None
+
+    def __next_position(
+        self,
+        indexed_jobs: list[tuple[int, JobConfig]],
+        immediate: bool,
+        run_start: datetime.datetime,
+    ) -> int:
+        """Position of the job to run next, by the start time in the current
+        config, or in the config order if immediate"""
+        if immediate:
+            return 0
+
+        def start_of(position: int) -> datetime.datetime:
+            job = self.__current_job(indexed_jobs[position][0])
+            if job is None:
+                # report removed jobs right away
+                return run_start
+            job_config = bot_config_for_job(self.bot_config, job)
+            return next_occurrence(job_config.start_time, run_start)
+
+        return min(range(len(indexed_jobs)), key=start_of)
+
+    def __run_account(
+        self, indexed_jobs: list[tuple[int, JobConfig]], immediate: bool
+    ) -> list[tuple[int, JobResult]]:
+        # jobs are looked up again at each start, the config may be edited
+        # while the account waits for its next job
+        indexed_jobs = list(indexed_jobs)
+        run_start = datetime.datetime.now()
+
+        session = None
+        has_slot = False
+        # the browser was closed while the next job was far away
+        browser_released = False
+        setup_error = ""
+        results = []
+        try:
+            while len(indexed_jobs) > 0:
+                idx, job = indexed_jobs.pop(
+                    self.__next_position(indexed_jobs, immediate, run_start)
+                )
+                current_job = self.__current_job(idx)
+                job = current_job or job
+                job_config = bot_config_for_job(self.bot_config, job)
+                result = JobResult(
+                    name=job.name or job.ticket_name,
+                    account=job_config.account,
+                    ticket_name=job.ticket_name,
+                    ticket_item_name=job.ticket_item_name,
+                )
+                results.append((idx, result))
+                if current_job is None:
+                    result.error = "removed from config"
+                    continue
+                if self.stop_event.is_set():
+                    result.error = "stopped"
+                    continue
+                if setup_error:
+                    result.error = f"skipped, {setup_error}"
+                    continue
+
+                # a bot may fail to load its model or to connect to the
+                # captcha service, the other accounts keep running
+                try:
+                    if session is None:
+                        # built without the lock, connecting may take long
+                        new_session = self.Session(
+                            bot=BotFactory.new_bot(job_config, self.model),
+                            job_index=idx,
+                        )
+                        with self.sessions_lock:
+                            session = new_session
+                            self.sessions[id(session)] = session
+                    with session.update_lock:
+                        # the config may have changed before update_config
+                        # could see this job
+                        session.job_index = idx
+                        job_config = bot_config_for_job(
+                            self.bot_config, self.__current_job(idx) or job
+                        )
+                        bot = BotFactory.apply_config(session.bot, job_config)
+                        with self.sessions_lock:
+                            session.bot = bot
+                except Exception as e:  # pylint: disable=broad-except
+                    logger.error("Cannot prepare job %s: %s", result.name, e)
+                    result.error = setup_error = repr(e)
+                    continue
+
+                def login_routine():
+                    nonlocal has_slot, browser_released
+                    bot = session.bot
+                    if bot.logged_in:
+                        return
+                    if not has_slot:
+                        account = bot.bot_config.account
+                        if not self.__acquire_browser_slot(account):
+                            return
+                        has_slot = True
+                    if bot.driver is None:
+                        if browser_released:
+                            BROWSER_RESTARTS.inc()
+                            browser_released = False
+                        bot.initial_browser()
+                    bot.login()
+
+                def book_routine():
+                    bot = session.bot
+                    if not bot.logged_in:
+                        return
+                    if bot.bot_config.watch_interval_sec > 0:
+                        result.booked = bot.watch(self.stop_event)
+                    else:
+                        result.booked = bot.book()
+
+                job_start = time.perf_counter()
+                try:
+                    if immediate:
+                        login_routine()
+                        book_routine()
+                    elif not self.__schedule_job(
+                        session, job_config, login_routine, book_routine
+                    ):
+                        result.error = "stopped"
+                except Exception as e:  # pylint: disable=broad-except
+                    logger.error("Job %s failed: %s", result.name, e)
+                    result.error = repr(e)
+                result.logged_in = session.bot.logged_in
+                result.duration_sec = time.perf_counter() - job_start
+                if not result.booked and not result.error:
+                    if self.stop_event.is_set():
+                        result.error = "stopped"
+                    elif not result.logged_in:
+                        result.error = "login failed"
+                    else:
+                        result.error = "book failed"
+
+                # let other accounts use the browser until the next login
+                if has_slot and not immediate and len(indexed_jobs) > 0:
+                    browser_released = self.__release_idle_browser(
+                        session, indexed_jobs, run_start
+                    )
+                    has_slot = not browser_released
+        finally:
+            if session is not None:
+                with self.sessions_lock:
+                    self.sessions.pop(id(session), None)
+                session.bot.close()
+            if has_slot:
+                self.browser_slots.release()
+        return results
+
+    def __release_idle_browser(
+        self,
+        session: Session,
+        indexed_jobs: list[tuple[int, JobConfig]],
+        run_start: datetime.datetime,
+    ) -> bool:
+        """Close the browser and free its slot if the next login is far,
+        return whether it was released"""
+        next_idx, _ = indexed_jobs[
+            self.__next_position(indexed_jobs, False, run_start)
+        ]
+        next_job = self.__current_job(next_idx)
+        if next_job is None:
+            return False
+        next_job_config = bot_config_for_job(self.bot_config, next_job)
+        next_login = min(
+            next_occurrence(next_job_config.pre_login_time),
+            next_occurrence(next_job_config.start_time),
+        )
+        idle_sec = (next_login - datetime.datetime.now()).total_seconds()
+        if idle_sec <= BROWSER_IDLE_RELEASE_SEC:
+            return False
+
+        logger.info(
+            "Release the browser of %s until %s",
+            next_job_config.account,
+            next_job_config.pre_login_time,
+        )
+        with session.update_lock:
+            session.bot.close()
+        self.browser_slots.release()
+        return True
@@ -0,0 +1,231 @@
+import time
+import bisect
+import threading
+import contextlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from deipnon.utils import get_logger
+
+logger = get_logger(__name__)
+
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+
+def escape_label_value(value) -> str:
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace('"', '\\"')
+        .replace("\n", "\\n")
+    )
+
+
+def format_labels(label_names: tuple[str, ...], values: tuple) -> str:
+    if len(label_names) == 0:
+        return ""
+    pairs = ",".join(
+        f'{name}="{escape_label_value(value)}"'
+        for name, value in zip(label_names, values)
+    )
+    return "{" + pairs + "}"
+
+
+class Counter:
+    """A monotonically increasing value per label set"""
+
+    def __init__(
+        self, name: str, documentation: str, label_names: tuple[str, ...] = ()
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.values: dict[tuple, float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = tuple(labels.get(name, "") for name in self.label_names)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def collect(self) -> list[str]:
+        with self.lock:
+            values = dict(self.values)
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} counter",
+        ]
+        for key, value in sorted(values.items()):
+            lines.append(
+                f"{self.name}{format_labels(self.label_names, key)} {value}"
+            )
+        return lines
+
+
+class Histogram:
+    """Count observations into cumulative buckets"""
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        # the last slot counts the observations above every bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[idx] += 1
+            self.sum += value
+
+    @contextlib.contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def collect(self) -> list[str]:
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        cumulative = 0
+        for bucket, count in zip(self.buckets, counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bucket}"}} {cumulative}')
+        cumulative += counts[-1]
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {cumulative}')
+        lines.append(f"{self.name}_sum {total}")
+        lines.append(f"{self.name}_count {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """All metrics in the prometheus text format"""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+CAPTCHA_INFERENCE_SECONDS = REGISTRY.register(
+    Histogram(
+        "deipnon_captcha_inference_seconds", "Time to decode one captcha"
+    )
+)
+LOGIN_SECONDS = REGISTRY.register(
+    Histogram("deipnon_login_seconds", "Time of login including retries")
+)
+BOOK_SECONDS = REGISTRY.register(
+    Histogram("deipnon_book_seconds", "Time of book including retries")
+)
+SCHEDULER_FIRING_ERROR_SECONDS = REGISTRY.register(
+    Histogram(
+        "deipnon_scheduler_firing_error_seconds",
+        "Delay between the scheduled and the actual start of a task",
+        buckets=(0.01, 0.05, 0.1, 0.2, 0.5, 1.0, 5.0, 30.0),
+    )
+)
+CAPTCHA_ATTEMPTS = REGISTRY.register(
+    Counter(
+        "deipnon_captcha_attempts_total", "Logins tried with a decoded captcha"
+    )
+)
+CAPTCHA_FAILURES = REGISTRY.register(
+    Counter("deipnon_captcha_failures_total", "Logins rejected by the portal")
+)
+RETRY_ATTEMPTS = REGISTRY.register(
+    Counter(
+        "deipnon_retry_attempts_total",
+        "Attempts of retried tasks by their outcome",
+        ("task", "outcome"),
+    )
+)
+BROWSER_RESTARTS = REGISTRY.register(
+    Counter(
+        "deipnon_browser_restarts_total",
+        "Browsers restarted by a new config or after being released to idle",
+    )
+)
+
+
+class MetricsServer:
+    """Serve REGISTRY on http://host:port/metrics"""
+
+    def __init__(self, port: int, host: str = "127.0.0.1"):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", maxsplit=1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = REGISTRY.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header(
+                    "Content-Type", "text/plain; version=0.0.4; charset=utf-8"
+                )
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                logger.debug(*args)
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+
+    def start(self):
+        host, port = self.httpd.server_address[:2]
+        logger.info("Serve metrics on http://%s:%d/metrics", host, port)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+_metrics_server = None
+_metrics_server_lock = threading.Lock()
+
+
+def start_metrics_server(port: int, host: str = "127.0.0.1") -> MetricsServer:
+    """Start the metrics endpoint once per process"""
+    global _metrics_server  # pylint: disable=global-statement
+    with _metrics_server_lock:
+        if _metrics_server is None:
+            _metrics_server = MetricsServer(port, host)
+            _metrics_server.start()
+        return _metrics_server
@@ -1,11 +1,59 @@
+import gc
+import ctypes
+import platform
+import threading
 from typing import Union
-from ultralytics import YOLO
 from PIL import Image
 
+from deipnon.utils import get_logger
+
+logger = get_logger(__name__)
+
+
+def trim_memory():
+    """Return the freed heap to the os, glibc keeps it cached otherwise"""
+    gc.collect()
+    if platform.system() == "Linux":
+        try:
+            ctypes.CDLL("libc.so.6").malloc_trim(0)
+        except (OSError, AttributeError):
+            pass
+
 
 class Captcha:
-    def __init__(self, model_path: str) -> None:
-        self.model = YOLO(model_path)
+    def __init__(self, model_path: str, num_threads: int = 0) -> None:
+        self.model_path = model_path
+        self.num_threads = num_threads
+        self.model = None
+        # one model may be shared by several bots running on threads
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        # ultralytics pulls in torch, only pay for it when a model is loaded
+        from ultralytics import (  # pylint: disable=import-outside-toplevel
+            YOLO,
+        )
+
+        self.set_num_threads(self.num_threads)
+        self.model = YOLO(self.model_path)
+
+    def set_num_threads(self, num_threads: int):
+        """Limit the inference threads of torch, 0 keeps the current limit"""
+        self.num_threads = num_threads
+        if num_threads > 0:
+            import torch  # pylint: disable=import-outside-toplevel
+
+            torch.set_num_threads(num_threads)
+
+    def release(self):
+        """Free the model, the next predict loads it again"""
+        with self.lock:
+            if self.model is None:
+                return
+            self.model = None
+            logger.info("Release yolo model %s", self.model_path)
+        trim_memory()
 
     def NMS(
         self,
@@ -54,7 +102,11 @@ class Captcha:
             input_data = images
 
         # predict by model
-        results = self.model.predict(input_data)
+        with self.lock:
+            if self.model is None:
+                logger.info("Reload yolo model %s", self.model_path)
+                self.load()
+            results = self.model.predict(input_data)
 
         result_str_list = []
         data_list = []
@@ -0,0 +1,188 @@
+import os
+import sys
+import json
+import pstats
+import cProfile
+import datetime
+import threading
+import contextlib
+from enum import Enum
+from collections import Counter
+
+from deipnon.utils import get_logger
+
+logger = get_logger(__name__)
+
+PROFILE_DIR_ENV = "DEIPNON_PROFILE_DIR"
+PROFILE_MODE_ENV = "DEIPNON_PROFILE_MODE"
+
+
+class PROFILE_MODE(Enum):
+    # sample the stacks only, cheap enough for the booking hot path
+    SAMPLE = "sample"
+    # sample and run cProfile, exact call counts but slows every call
+    FULL = "full"
+
+
+def get_profile_dir(config_profile_dir: str) -> str:
+    """The environment variable wins over the config, empty to disable"""
+    return os.environ.get(PROFILE_DIR_ENV, config_profile_dir)
+
+
+def get_profile_mode(config_profile_mode: PROFILE_MODE) -> PROFILE_MODE:
+    """The environment variable wins over the config"""
+    env_mode = os.environ.get(PROFILE_MODE_ENV)
+    if not env_mode:
+        return config_profile_mode
+    try:
+        return PROFILE_MODE(env_mode)
+    except ValueError:
+        logger.warning("Ignore invalid %s=%s", PROFILE_MODE_ENV, env_mode)
+        return config_profile_mode
+
+
+class StackSampler:
+    """Sample the stack of one thread into collapsed stacks"""
+
+    def __init__(self, thread_id: int, interval_sec: float):
+        self.thread_id = thread_id
+        self.interval_sec = interval_sec
+        self.stacks: Counter = Counter()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.__sample, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def __sample(self):
+        while not self.stop_event.wait(self.interval_sec):
+            # pylint: disable-next=protected-access
+            frame = sys._current_frames().get(self.thread_id)
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append(
+                    f"{code.co_name} "
+                    f"({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+                )
+                frame = frame.f_back
+            if len(frames) > 0:
+                self.stacks[";".join(reversed(frames))] += 1
+
+    def dump(self, file_path: str):
+        with open(file_path, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class PhaseProfiler:
+    """Profile the phases of a bot and dump one profile per phase run.
+
+    Each run writes <phase>.collapsed (sampled stacks for flamegraph tools)
+    and <phase>.commands.json (webdriver commands issued during the phase)
+    into profile_dir, plus <phase>.pstats (cProfile) in the full mode.
+    """
+
+    def __init__(
+        self,
+        profile_dir: str,
+        mode: PROFILE_MODE = PROFILE_MODE.SAMPLE,
+        sample_interval_sec: float = 0.005,
+    ):
+        self.profile_dir = profile_dir
+        self.mode = mode
+        self.sample_interval_sec = sample_interval_sec
+        self.run_count = 0
+        self.lock = threading.Lock()
+        # cProfile cannot nest, a nested phase is only sampled
+        self.active = threading.local()
+
+    def __prefix(self, phase: str) -> str:
+        with self.lock:
+            self.run_count += 1
+            run_count = self.run_count
+        timestamp = datetime.datetime.now().strftime(r"%Y%m%d-%H%M%S")
+        return os.path.join(
+            self.profile_dir,
+            f"{timestamp}-{threading.get_ident():x}-{run_count:03d}-{phase}",
+        )
+
+    @contextlib.contextmanager
+    def profile(self, phase: str, driver=None):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        prefix = self.__prefix(phase)
+
+        # count the webdriver commands, WebElement calls go through
+        # driver.execute as well
+        commands: Counter = Counter()
+        original_execute = None
+        if driver is not None:
+            original_execute = driver.execute
+
+            def counting_execute(driver_command, params=None):
+                commands[driver_command] += 1
+                return original_execute(driver_command, params)
+
+            driver.execute = counting_execute
+
+        profiler = None
+        if self.mode == PROFILE_MODE.FULL and not getattr(
+            self.active, "value", False
+        ):
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+                self.active.value = True
+            except ValueError:
+                # python 3.12+ allows one profiler per process
+                logger.debug("Another profiler is active, only sample")
+                profiler = None
+        sampler = StackSampler(threading.get_ident(), self.sample_interval_sec)
+        sampler.start()
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                self.active.value = False
+            sampler.stop()
+            if original_execute is not None:
+                driver.execute = original_execute
+
+            if profiler is not None:
+                pstats.Stats(profiler).dump_stats(prefix + ".pstats")
+            sampler.dump(prefix + ".collapsed")
+            with open(prefix + ".commands.json", "w", encoding="utf-8") as f:
+                json.dump(dict(commands.most_common()), f, indent=2)
+            logger.info(
+                "Profile %s: %d webdriver commands, saved to %s.*",
+                phase,
+                sum(commands.values()),
+                prefix,
+            )
+
+
+_profilers: dict[tuple[str, PROFILE_MODE], PhaseProfiler] = {}
+_profilers_lock = threading.Lock()
+
+
+def profile_phase(
+    profile_dir: str,
+    phase: str,
+    driver=None,
+    mode: PROFILE_MODE = PROFILE_MODE.SAMPLE,
+):
+    """Profile the phase if profile_dir is given, otherwise do nothing"""
+    if not profile_dir:
+        return contextlib.nullcontext()
+    with _profilers_lock:
+        profiler = _profilers.get((profile_dir, mode))
+        if profiler is None:
+            profiler = _profilers[(profile_dir, mode)] = PhaseProfiler(
+                profile_dir, mode
+            )
+    return profiler.profile(phase, driver)
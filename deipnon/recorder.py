@@ -0,0 +1,202 @@
+import json
+import time
+import base64
+import zipfile
+import threading
+from typing import Optional
+
+import msgspec
+from selenium.common.exceptions import WebDriverException
+
+from deipnon.utils import get_logger
+
+logger = get_logger(__name__)
+
+MANIFEST_NAME = "manifest.json"
+
+
+class Exchange(msgspec.Struct):
+    """One http request and its recorded response"""
+
+    time_sec: float
+    latency_sec: float
+    method: str
+    url: str
+    status: int
+    headers: dict[str, str]
+    request_body: Optional[str] = None
+    body_file: Optional[str] = None
+
+
+class Snapshot(msgspec.Struct):
+    time_sec: float
+    label: str
+    url: str
+    file: str
+
+
+class Recording(msgspec.Struct):
+    started_at: float
+    exchanges: list[Exchange] = []
+    snapshots: list[Snapshot] = []
+    captchas: list[Snapshot] = []
+
+
+class SessionRecorder:
+    """Record the pages, http exchanges and captchas of a booking session.
+
+    Everything is written into one zip archive which ReplayServer can serve.
+    Http exchanges are read from the chromium performance log, so they are
+    only recorded for chrome and edge, except the captchas the bot fetches
+    itself which are recorded for every browser.
+    """
+
+    def __init__(self, archive_path: str):
+        self.archive_path = archive_path
+        self.start = time.perf_counter()
+        self.recording = Recording(started_at=time.time())
+        self.files: dict[str, bytes] = {}
+        # requestId -> (request, wall time it was sent)
+        self.pending_requests: dict[str, tuple[dict, float]] = {}
+        self.lock = threading.Lock()
+
+    def __now(self) -> float:
+        return time.perf_counter() - self.start
+
+    def snapshot(self, label: str, url: str, html: str):
+        with self.lock:
+            file = f"snapshots/{len(self.recording.snapshots):03d}.html"
+            self.files[file] = html.encode("utf-8")
+            self.recording.snapshots.append(
+                Snapshot(
+                    time_sec=self.__now(), label=label, url=url, file=file
+                )
+            )
+
+    def captcha(
+        self,
+        url: str,
+        image_bytes: bytes,
+        status: int = 200,
+        headers: Optional[dict[str, str]] = None,
+        latency_sec: float = 0.0,
+    ):
+        """Record a captcha fetched outside the browser, also as an exchange
+        so that ReplayServer serves it"""
+        with self.lock:
+            now = self.__now()
+            file = f"captchas/{len(self.recording.captchas):03d}.img"
+            self.files[file] = image_bytes
+            self.recording.captchas.append(
+                Snapshot(time_sec=now, label="captcha", url=url, file=file)
+            )
+            self.recording.exchanges.append(
+                Exchange(
+                    time_sec=now - latency_sec,
+                    latency_sec=latency_sec,
+                    method="GET",
+                    url=url,
+                    status=status,
+                    headers={
+                        str(k): str(v) for k, v in (headers or {}).items()
+                    },
+                    body_file=file,
+                )
+            )
+
+    def collect_network(self, driver):
+        """Drain the performance log of the driver into exchanges"""
+        try:
+            entries = driver.get_log("performance")
+        except (WebDriverException, AttributeError, ValueError):
+            return
+
+        for entry in entries:
+            message = json.loads(entry["message"])["message"]
+            method, params = message["method"], message.get("params", {})
+            if method == "Network.requestWillBeSent":
+                self.pending_requests[params["requestId"]] = (
+                    params["request"],
+                    params["wallTime"],
+                )
+            elif method == "Network.responseReceived":
+                self.__add_exchange(driver, params)
+
+    def __add_exchange(self, driver, params: dict):
+        request_id = params["requestId"]
+        request, sent_at = self.pending_requests.pop(
+            request_id, ({"method": "GET", "postData": None}, None)
+        )
+        response = params["response"]
+        if response["url"].startswith("data:"):
+            return
+
+        try:
+            body = driver.execute_cdp_cmd(
+                "Network.getResponseBody", {"requestId": request_id}
+            )
+        except WebDriverException:
+            body = None
+
+        # receiveHeadersEnd is the delay of the response in milliseconds
+        timing = response.get("timing") or {}
+        latency_sec = timing.get("receiveHeadersEnd", 0) / 1000
+        with self.lock:
+            body_file = None
+            if body is not None:
+                body_file = f"responses/{len(self.recording.exchanges):04d}"
+                self.files[body_file] = (
+                    base64.b64decode(body["body"])
+                    if body["base64Encoded"]
+                    else body["body"].encode("utf-8")
+                )
+            self.recording.exchanges.append(
+                Exchange(
+                    time_sec=(
+                        sent_at - self.recording.started_at
+                        if sent_at is not None
+                        else self.__now()
+                    ),
+                    latency_sec=latency_sec,
+                    method=request["method"],
+                    url=response["url"],
+                    status=response["status"],
+                    headers={
+                        str(k): str(v) for k, v in response["headers"].items()
+                    },
+                    request_body=request.get("postData"),
+                    body_file=body_file,
+                )
+            )
+
+    def save(self):
+        """Write the archive, it is rewritten on every call"""
+        with self.lock:
+            with zipfile.ZipFile(
+                self.archive_path, "w", compression=zipfile.ZIP_DEFLATED
+            ) as zip_ref:
+                zip_ref.writestr(
+                    MANIFEST_NAME, msgspec.json.encode(self.recording)
+                )
+                for file, data in self.files.items():
+                    zip_ref.writestr(file, data)
+        logger.info(
+            "Record %d exchanges, %d snapshots and %d captchas to %s",
+            len(self.recording.exchanges),
+            len(self.recording.snapshots),
+            len(self.recording.captchas),
+            self.archive_path,
+        )
+
+
+def load_recording(archive_path: str) -> tuple[Recording, dict[str, bytes]]:
+    with zipfile.ZipFile(archive_path, "r") as zip_ref:
+        recording = msgspec.json.decode(
+            zip_ref.read(MANIFEST_NAME), type=Recording
+        )
+        files = {
+            name: zip_ref.read(name)
+            for name in zip_ref.namelist()
+            if name != MANIFEST_NAME
+        }
+    return recording, files
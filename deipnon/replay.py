@@ -0,0 +1,133 @@
+import time
+import threading
+from urllib.parse import urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from deipnon.utils import get_logger
+from deipnon.recorder import Exchange, load_recording
+
+logger = get_logger(__name__)
+
+# these headers describe the original transfer, not the decoded body
+SKIPPED_HEADERS = frozenset(
+    (
+        "content-encoding",
+        "content-length",
+        "transfer-encoding",
+        "connection",
+        "keep-alive",
+    )
+)
+
+
+def path_of(url: str) -> str:
+    parts = urlsplit(url)
+    return parts.path + ("?" + parts.query if parts.query else "")
+
+
+class ReplayServer:
+    """Serve a recorded session locally with the recorded response delays.
+
+    Requests are matched by method and path, the n-th request of a path gets
+    the n-th recorded response of it (the last one is repeated). Point
+    web_url to this server to rerun the bot offline.
+    """
+
+    def __init__(
+        self,
+        archive_path: str,
+        host: str = "127.0.0.1",
+        port: int = 8000,
+        speed: float = 1.0,
+    ):
+        recording, self.files = load_recording(archive_path)
+        self.speed = speed
+        self.exchanges: dict[tuple[str, str], list[Exchange]] = {}
+        for exchange in recording.exchanges:
+            key = (exchange.method, path_of(exchange.url))
+            self.exchanges.setdefault(key, []).append(exchange)
+        # the browser log is drained later than the captchas fetched by the
+        # bot are recorded, so restore the order they were requested in
+        for exchanges in self.exchanges.values():
+            exchanges.sort(key=lambda exchange: exchange.time_sec)
+        self.served: dict[tuple[str, str], int] = {}
+        self.lock = threading.Lock()
+        logger.info(
+            "Replay %d exchanges of %s", len(recording.exchanges), archive_path
+        )
+        self.httpd = ThreadingHTTPServer((host, port), self.__make_handler())
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def next_exchange(self, method: str, path: str):
+        key = (method, path)
+        with self.lock:
+            exchanges = self.exchanges.get(key)
+            if not exchanges:
+                return None
+            idx = self.served.get(key, 0)
+            self.served[key] = idx + 1
+        return exchanges[min(idx, len(exchanges) - 1)]
+
+    def serve_forever(self):
+        logger.info("Replay server is listening on %s", self.url)
+        self.httpd.serve_forever()
+
+    def start(self) -> threading.Thread:
+        t = threading.Thread(target=self.serve_forever, daemon=True)
+        t.start()
+        return t
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def replay(self):
+                length = int(self.headers.get("Content-Length", 0))
+                if length > 0:
+                    self.rfile.read(length)
+
+                exchange = server.next_exchange(self.command, self.path)
+                if exchange is None:
+                    logger.warning(
+                        "Not recorded: %s %s", self.command, self.path
+                    )
+                    self.send_error(404)
+                    return
+
+                time.sleep(exchange.latency_sec / server.speed)
+                body = (
+                    server.files[exchange.body_file]
+                    if exchange.body_file is not None
+                    else b""
+                )
+                self.send_response(exchange.status)
+                for name, value in exchange.headers.items():
+                    if name.lower() in SKIPPED_HEADERS:
+                        continue
+                    # folded headers are joined with "\n" by chromium
+                    for line in value.split("\n"):
+                        self.send_header(name, line)
+                # the bot reads the session id from the cookie
+                if "JSESSIONID" not in self.headers.get("Cookie", ""):
+                    self.send_header(
+                        "Set-Cookie", "JSESSIONID=replay; Path=/"
+                    )
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = replay
+            do_POST = replay
+
+            def log_message(self, *args):
+                logger.debug(*args)
+
+        return Handler
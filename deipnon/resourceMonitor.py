@@ -0,0 +1,60 @@
+import threading
+
+import psutil
+
+from deipnon.utils import get_logger
+
+logger = get_logger(__name__)
+
+MIB = 1024 * 1024
+
+
+class ResourceMonitor:
+    """Periodically log the RSS of this process and the browsers.
+
+    Webdrivers are children of this process and the browsers are children
+    of the webdrivers, so every descendant process is counted as browser.
+    """
+
+    def __init__(self, interval_sec: float):
+        self.interval_sec = interval_sec
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.process = psutil.Process()
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.__monitor, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def snapshot(self) -> tuple[int, int, int]:
+        """RSS of python, RSS of the browsers and the number of browsers"""
+        python_rss = self.process.memory_info().rss
+        browser_rss = 0
+        browser_count = 0
+        for child in self.process.children(recursive=True):
+            try:
+                browser_rss += child.memory_info().rss
+                browser_count += 1
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                pass
+        return python_rss, browser_rss, browser_count
+
+    def report(self):
+        python_rss, browser_rss, browser_count = self.snapshot()
+        logger.info(
+            "RSS python %.1f MiB, browser %.1f MiB (%d processes), "
+            "total %.1f MiB",
+            python_rss / MIB,
+            browser_rss / MIB,
+            browser_count,
+            (python_rss + browser_rss) / MIB,
+        )
+
+    def __monitor(self):
+        self.report()
+        while not self.stop_event.wait(self.interval_sec):
+            self.report()
@@ -0,0 +1,105 @@
+import time
+import datetime
+import threading
+from typing import Callable, Optional
+
+import schedule
+
+from deipnon.utils import get_logger
+from deipnon.metrics import SCHEDULER_FIRING_ERROR_SECONDS
+
+logger = get_logger(__name__)
+
+
+def next_occurrence(
+    at_time: str, now: Optional[datetime.datetime] = None
+) -> datetime.datetime:
+    """The next datetime of the daily "HH:MM" time, same as schedule does"""
+    now = now or datetime.datetime.now()
+    target = datetime.datetime.combine(
+        now.date(), datetime.time.fromisoformat(at_time)
+    )
+    if target <= now:
+        target += datetime.timedelta(days=1)
+    return target
+
+
+class OneShotScheduler:
+    """Run each named task once at its "HH:MM" time.
+
+    The time of a pending task can be changed from another thread while
+    waiting, e.g. when the config is reloaded.
+    """
+
+    def __init__(self):
+        self.scheduler = schedule.Scheduler()
+        self.jobs: dict[str, schedule.Job] = {}
+        self.funcs: dict[str, Callable] = {}
+        self.lock = threading.RLock()
+
+    def add(self, name: str, at_time: str, func: Callable):
+        with self.lock:
+            self.funcs[name] = func
+            self.jobs[name] = self.scheduler.every().day.at(at_time).do(func)
+
+    def reschedule(self, name: str, at_time: str) -> bool:
+        """Move a pending task to at_time, False if it is not pending"""
+        with self.lock:
+            job = self.jobs.get(name)
+            if job is None:
+                return False
+            self.scheduler.cancel_job(job)
+            self.jobs[name] = self.scheduler.every().day.at(at_time).do(
+                self.funcs[name]
+            )
+        logger.info("Reschedule %s to %s", name, at_time)
+        return True
+
+    def __pop_due(self) -> list[tuple[datetime.datetime, Callable]]:
+        """Remove the due tasks, earliest first, with their planned time"""
+        with self.lock:
+            due = sorted(
+                (job.next_run, name)
+                for name, job in self.jobs.items()
+                if job.should_run
+            )
+            for _, name in due:
+                self.scheduler.cancel_job(self.jobs.pop(name))
+            return [(next_run, self.funcs.pop(name)) for next_run, name in due]
+
+    def run(
+        self,
+        stop_event: Optional[threading.Event] = None,
+        poll_sec: float = 0.1,
+    ) -> bool:
+        """Wait and run until every task is done, return False if stopped"""
+        while True:
+            with self.lock:
+                if len(self.jobs) == 0:
+                    return True
+                if stop_event is not None and stop_event.is_set():
+                    self.scheduler.clear()
+                    self.jobs.clear()
+                    logger.info("Schedule stopped")
+                    return False
+
+            # run outside the lock, the other tasks can be rescheduled
+            # while a task runs
+            for next_run, func in self.__pop_due():
+                SCHEDULER_FIRING_ERROR_SECONDS.observe(
+                    (datetime.datetime.now() - next_run).total_seconds()
+                )
+                func()
+            time.sleep(poll_sec)
+
+
+def run_at(
+    tasks: list[tuple[str, Callable]],
+    stop_event: Optional[threading.Event] = None,
+    poll_sec: float = 0.1,
+) -> bool:
+    """Run each task once at its "HH:MM" time, return False if stopped"""
+    scheduler = OneShotScheduler()
+    for idx, (at_time, func) in enumerate(tasks):
+        scheduler.add(str(idx), at_time, func)
+    return scheduler.run(stop_event, poll_sec)
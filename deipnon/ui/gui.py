@@ -1,14 +1,19 @@
-import time
 import threading
+from concurrent.futures import ThreadPoolExecutor
 
-import schedule
 import ttkbootstrap as ttk
 from ttkbootstrap.constants import LEFT
 
 from deipnon.utils import get_config_file_path, get_logger
-from deipnon.config import read_from_toml_file, write_to_toml_file
+from deipnon.config import (
+    BotConfig,
+    merge_config,
+    read_from_toml_file,
+    write_to_toml_file,
+)
 from deipnon.driver import check_webdriver, download_webdriver
-from deipnon.bot.botFactory import BotFactory
+from deipnon.jobRunner import JobRunner
+from deipnon.configWatcher import ConfigWatcher
 from deipnon.ui.logConsole import LogConsole, apply_logging_gui_to_all_logger
 
 logger = get_logger(__name__)
@@ -18,10 +23,13 @@ class GUI:
     def __init__(self):
         self.config_path = None
         self.config = None
-        self.bot = None
+        self.job_runner = None
+        self.config_watcher = None
         self.root = None
         self.book_btn = None
         self.schedule_btn = None
+        self.status_label = None
+        self.progress_bar = None
 
     def show(self):
         self.root = ttk.Window(themename="darkly")
@@ -45,17 +53,87 @@ class GUI:
             command=self.__run_schedule_tasks,
         )
         self.schedule_btn.grid(row=1, column=1)
+        self.__set_buttons_state(ttk.DISABLED)
 
-        self.__read_config()
-        self.__check_webdriver()
-        self.__initial_bot()
+        self.status_label = ttk.Label(self.root, text="Initializing...")
+        self.status_label.grid(row=2, column=0, sticky=ttk.W)
+        self.progress_bar = ttk.Progressbar(
+            self.root, mode="indeterminate", bootstyle="info"
+        )
+        self.progress_bar.grid(row=2, column=1, sticky=ttk.EW)
+        self.progress_bar.start()
 
         self.root.protocol("WM_DELETE_WINDOW", self.__on_closing)
+        # start after mainloop is running so the worker can use root.after
+        self.root.after(0, self.__start_initialization)
         self.root.mainloop()
 
+    def __run_on_ui(self, func, *args):
+        """Call func on the Tk thread"""
+        self.root.after(0, func, *args)
+
+    def __set_buttons_state(self, state):
+        self.book_btn.state((state, ))
+        self.schedule_btn.state((state, ))
+
+    def __set_status(self, text: str):
+        self.status_label.configure(text=text)
+
+    def __on_initialized(self):
+        self.progress_bar.stop()
+        self.progress_bar.grid_remove()
+        self.__set_status("Ready")
+        self.__set_buttons_state(ttk.NORMAL)
+
+    def __on_initialization_failed(self, reason: str):
+        self.progress_bar.stop()
+        self.__set_status(f"Initialization failed: {reason}")
+
+    def __start_initialization(self):
+        def initialize():
+            try:
+                self.__run_on_ui(self.__set_status, "Reading config")
+                self.__read_config()
+
+                # downloading the webdriver and loading the model are
+                # independent of each other
+                self.__run_on_ui(
+                    self.__set_status, "Checking webdriver and loading model"
+                )
+                with ThreadPoolExecutor(max_workers=2) as executor:
+                    futures = [
+                        executor.submit(self.__check_webdriver),
+                        executor.submit(self.__initial_bot),
+                    ]
+                    for future in futures:
+                        future.result()
+                self.__start_config_watcher()
+            except Exception as e:  # pylint: disable=broad-except
+                logger.error("Initialization failed: %s", e)
+                self.__run_on_ui(self.__on_initialization_failed, str(e))
+                return
+            self.__run_on_ui(self.__on_initialized)
+
+        t = threading.Thread(target=initialize, daemon=True)
+        t.start()
+
     def __on_closing(self):
-        self.bot.close()
-        self.root.destroy()
+        # ignore further clicks while the browsers are quitting
+        self.root.protocol("WM_DELETE_WINDOW", lambda: None)
+        self.root.withdraw()
+        if self.config_watcher:
+            self.config_watcher.stop()
+
+        def close():
+            try:
+                if self.job_runner:
+                    self.job_runner.close()
+            finally:
+                self.__run_on_ui(self.root.destroy)
+
+        # quitting the browsers can take long, keep the Tk loop responsive
+        t = threading.Thread(target=close, daemon=True)
+        t.start()
 
     def __read_config(self):
         self.config_path = get_config_file_path()
@@ -68,65 +146,53 @@ class GUI:
             )
 
     def __initial_bot(self):
-        self.bot = BotFactory.new_bot(self.config)
+        # a config without jobs is run as a single job
+        self.job_runner = JobRunner(self.config)
+
+    def __start_config_watcher(self):
+        self.config_watcher = ConfigWatcher(
+            self.config_path, self.__on_config_changed
+        )
+        self.config_watcher.start()
+
+    def __on_config_changed(self, new_config: BotConfig, changed: set[str]):
+        # keep the downloaded webdriver path unless the file changes it
+        self.config = merge_config(self.config, new_config, changed)
+        if changed & {"web_driver_type", "web_driver_path"}:
+            self.__check_webdriver()
+        self.job_runner.update_config(self.config)
 
     def __update_config(self):
         write_to_toml_file(self.config_path, self.config)
 
     def __run_book_tasks(self):
-        self.book_btn.state((ttk.DISABLED, ))
-        self.schedule_btn.state((ttk.DISABLED, ))
+        self.__set_buttons_state(ttk.DISABLED)
 
         def tasks():
             logger.info("Start working...")
-            self.bot.initial_browser()
-            self.bot.login()
-            self.bot.book()
-            self.bot.close()
-            logger.info("Finish")
-            self.book_btn.state((ttk.NORMAL, ))
-            self.schedule_btn.state((ttk.NORMAL, ))
+            try:
+                self.job_runner.run(immediate=True)
+            except Exception as e:  # pylint: disable=broad-except
+                logger.error("Jobs failed: %s", e)
+            finally:
+                logger.info("Finish")
+                self.__run_on_ui(self.__set_buttons_state, ttk.NORMAL)
 
         t = threading.Thread(target=tasks, daemon=True)
         t.start()
 
     def __run_schedule_tasks(self):
-        self.book_btn.state((ttk.DISABLED, ))
-        self.schedule_btn.state((ttk.DISABLED, ))
-
-        start_time = self.config.start_time
-        pre_login_time = self.config.pre_login_time
-        logger.info("Login time: %s", pre_login_time)
-        logger.info("Book time: %s", start_time)
-
-        def schedule_wrapper(func):
-            def wrapper():
-                func()
-                return schedule.CancelJob
-
-            return wrapper
-
-        def login_routine():
-            self.bot.initial_browser()
-            self.bot.login()
-
-        schedule.every().day.at(pre_login_time).do(
-            schedule_wrapper(login_routine)
-        )
-        schedule.every().day.at(start_time).do(schedule_wrapper(self.bot.book))
+        self.__set_buttons_state(ttk.DISABLED)
 
         def tasks():
             logger.info("Start working...")
-            while True:
-                schedule.run_pending()
-                if len(schedule.get_jobs()) > 0:
-                    time.sleep(0.1)
-                else:
-                    self.bot.close()
-                    logger.info("Finish")
-                    break
-            self.book_btn.state((ttk.NORMAL, ))
-            self.schedule_btn.state((ttk.NORMAL, ))
+            try:
+                self.job_runner.run()
+            except Exception as e:  # pylint: disable=broad-except
+                logger.error("Jobs failed: %s", e)
+            finally:
+                logger.info("Finish")
+                self.__run_on_ui(self.__set_buttons_state, ttk.NORMAL)
 
         t = threading.Thread(target=tasks, daemon=True)
         t.start()
@@ -1,4 +1,6 @@
 import logging
+import tkinter
+
 import ttkbootstrap as ttk
 
 
@@ -23,6 +25,14 @@ class LoggingToGUI(logging.Handler):
     def emit(self, record):
         formatted_msg = self.format(record)
         formatted_msg = formatted_msg + "\n"
+        # records may come from worker threads, only touch Tk on its thread
+        try:
+            self.console.after(0, self.__append, formatted_msg)
+        except (tkinter.TclError, RuntimeError):
+            # the window has been destroyed while the workers are stopping
+            pass
+
+    def __append(self, formatted_msg: str):
         self.console.configure(state=ttk.NORMAL)
         self.console.insert(ttk.END, formatted_msg)
         self.console.configure(state=ttk.DISABLED)
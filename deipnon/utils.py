@@ -26,9 +26,9 @@ def get_logger(name: str):
 logger = get_logger(__name__)
 
 
-def get_config_file_path():
+def get_config_file_path(use_argv: bool = True):
     """find out config file path from arguments and environment variables or using default values"""
-    if len(sys.argv) > 1:
+    if use_argv and len(sys.argv) > 1:
         config_path = sys.argv[-1]
         logger.info("config file path from arguement: %s", config_path)
         return config_path
@@ -47,10 +47,43 @@ def get_config_file_path():
 
 
 def download_file(
-    url: str, file_path: str, verify: bool = True, timeout: int = 30
+    url: str,
+    file_path: str,
+    verify: bool = True,
+    timeout: int = 30,
+    chunk_size: int = 1 << 20,
+    max_retries: int = 5,
 ):
-    with requests.get(url, stream=True, verify=verify, timeout=timeout) as r:
-        r.raise_for_status()
-        with open(file_path, "wb") as f:
-            for chunk in r.iter_content(chunk_size=8192):
-                f.write(chunk)
+    """download url to file_path, an interrupted download resumes from file_path.part"""
+    part_path = file_path + ".part"
+    for i in range(max_retries):
+        downloaded = (
+            os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        )
+        headers = {"Range": f"bytes={downloaded}-"} if downloaded > 0 else {}
+        try:
+            with requests.get(
+                url,
+                headers=headers,
+                stream=True,
+                verify=verify,
+                timeout=timeout,
+            ) as r:
+                if r.status_code == 416:  # already complete
+                    break
+                r.raise_for_status()
+                # the server may ignore the range and send the whole file
+                mode = "ab" if r.status_code == 206 else "wb"
+                with open(part_path, mode) as f:
+                    for chunk in r.iter_content(chunk_size=chunk_size):
+                        f.write(chunk)
+            break
+        except (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.ChunkedEncodingError,
+            requests.exceptions.Timeout,
+        ) as e:
+            if i + 1 == max_retries:
+                raise
+            logger.warning("Download interrupted (%s), resuming", e)
+    os.replace(part_path, file_path)
@@ -0,0 +1,214 @@
+import io
+import os
+import json
+import hashlib
+import tarfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from deipnon import driver
+from deipnon.driver import WEB_DRIVER_TYPE, download_webdriver, provision
+from deipnon.utils import download_file
+
+
+class FakeUpstream:
+    """Serve files from memory, standing in for the webdriver releases"""
+
+    def __init__(self):
+        self.files: dict[str, bytes] = {}
+        self.requests: list[tuple[str, str]] = []
+        # bytes to send before dropping the connection, per path, once
+        self.cut_after: dict[str, int] = {}
+        self.support_range = True
+
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                range_header = self.headers.get("Range", "")
+                upstream.requests.append((self.path, range_header))
+                data = upstream.files.get(self.path)
+                if data is None:
+                    self.send_error(404)
+                    return
+
+                start = 0
+                if upstream.support_range and range_header:
+                    start = int(range_header[len("bytes=") :].split("-")[0])
+                    if start >= len(data):
+                        self.send_response(416)
+                        self.send_header("Content-Length", "0")
+                        self.end_headers()
+                        return
+                    self.send_response(206)
+                    self.send_header(
+                        "Content-Range",
+                        f"bytes {start}-{len(data) - 1}/{len(data)}",
+                    )
+                else:
+                    self.send_response(200)
+                body = data[start:]
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+
+                cut_after = upstream.cut_after.pop(self.path, None)
+                if cut_after is not None:
+                    self.wfile.write(body[:cut_after])
+                    self.wfile.flush()
+                    self.close_connection = True
+                    return
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(
+            target=self.httpd.serve_forever, daemon=True
+        )
+
+    def url(self, path: str) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}{path}"
+
+    def count(self, path: str) -> int:
+        return sum(
+            1 for request_path, _ in self.requests if request_path == path
+        )
+
+
+@pytest.fixture
+def upstream():
+    server = FakeUpstream()
+    server.thread.start()
+    yield server
+    server.httpd.shutdown()
+    server.httpd.server_close()
+
+
+def make_tar_gz(name: str, data: bytes) -> bytes:
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as tar_ref:
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mode = 0o755
+        tar_ref.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+def test_download_resumes_after_interruption(upstream, tmp_path):
+    data = os.urandom(256 * 1024)
+    upstream.files["/archive.bin"] = data
+    upstream.cut_after["/archive.bin"] = 100 * 1024
+    file_path = tmp_path / "archive.bin"
+
+    download_file(
+        upstream.url("/archive.bin"), str(file_path), chunk_size=4096
+    )
+
+    assert file_path.read_bytes() == data
+    assert not os.path.exists(str(file_path) + ".part")
+    (_, first_range), (_, second_range) = upstream.requests
+    assert first_range == ""
+    resumed_from = int(second_range[len("bytes=") : -1])
+    assert 0 < resumed_from <= 100 * 1024
+
+
+def test_download_restarts_when_range_is_ignored(upstream, tmp_path):
+    data = os.urandom(64 * 1024)
+    upstream.files["/archive.bin"] = data
+    upstream.support_range = False
+    file_path = tmp_path / "archive.bin"
+    # a stale partial download which must not be appended to
+    (tmp_path / "archive.bin.part").write_bytes(b"stale" * 100)
+
+    download_file(upstream.url("/archive.bin"), str(file_path))
+
+    assert file_path.read_bytes() == data
+    assert upstream.requests[0][1] == "bytes=500-"
+
+
+def test_download_completes_on_416(upstream, tmp_path):
+    data = os.urandom(1024)
+    upstream.files["/archive.bin"] = data
+    file_path = tmp_path / "archive.bin"
+    (tmp_path / "archive.bin.part").write_bytes(data)
+
+    download_file(upstream.url("/archive.bin"), str(file_path))
+
+    assert file_path.read_bytes() == data
+
+
+def test_checksum_mismatch_removes_archive(upstream, tmp_path):
+    archive = make_tar_gz("geckodriver", b"binary")
+    upstream.files["/geckodriver.tar.gz"] = archive
+    store_folder = tmp_path / "geckodriver"
+
+    with pytest.raises(RuntimeError, match="Checksum mismatch"):
+        provision(
+            str(store_folder),
+            "v1",
+            "linux64",
+            upstream.url("/geckodriver.tar.gz"),
+            "geckodriver",
+            expected_sha256="0" * 64,
+        )
+
+    assert not (store_folder / "v1" / "geckodriver.tar.gz").exists()
+    assert not (store_folder / "v1" / "linux64").exists()
+
+
+def test_download_webdriver_from_manifest(upstream, tmp_path, monkeypatch):
+    monkeypatch.setattr(driver, "get_platform", lambda: "linux64")
+    archive = make_tar_gz("geckodriver", b"binary")
+    upstream.files["/geckodriver-v1-linux64.tar.gz"] = archive
+    upstream.files["/manifest.json"] = json.dumps(
+        {
+            "tag_name": "v1",
+            "assets": [
+                {
+                    "name": "geckodriver-v1-linux64.tar.gz",
+                    "browser_download_url": upstream.url(
+                        "/geckodriver-v1-linux64.tar.gz"
+                    ),
+                    "size": len(archive),
+                    "digest": "sha256:" + hashlib.sha256(archive).hexdigest(),
+                }
+            ],
+        }
+    ).encode("utf-8")
+    webdriver_path = str(tmp_path / "geckodriver" / "geckodriver")
+
+    for _ in range(2):
+        binary_path = download_webdriver(
+            WEB_DRIVER_TYPE.FIREFOX,
+            webdriver_path,
+            manifest_url=upstream.url("/manifest.json"),
+        )
+        with open(binary_path, "rb") as f:
+            assert f.read() == b"binary"
+        assert os.access(binary_path, os.X_OK)
+
+    # the manifest is cached within its ttl and the version is unpacked once
+    assert upstream.count("/manifest.json") == 1
+    assert upstream.count("/geckodriver-v1-linux64.tar.gz") == 1
+
+
+def test_stale_manifest_is_fetched_again(upstream, tmp_path):
+    upstream.files["/manifest.json"] = b'{"version": 1}'
+    cache_folder = str(tmp_path / ".manifests")
+
+    driver.fetch_manifest(upstream.url("/manifest.json"), cache_folder)
+    upstream.files["/manifest.json"] = b'{"version": 2}'
+    cached, _ = driver.fetch_manifest(
+        upstream.url("/manifest.json"), cache_folder
+    )
+    fetched, _ = driver.fetch_manifest(
+        upstream.url("/manifest.json"), cache_folder, ttl_sec=0
+    )
+
+    assert cached == {"version": 1}
+    assert fetched == {"version": 2}
+    assert upstream.count("/manifest.json") == 2